@@ -0,0 +1,47 @@
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import httpx
+
+from src.extract import parse_resume_links
+
+# Replaces the fixtures with live pages: python -m bench.record [query]
+# A benchmark run is only comparable to a baseline measured on the same fixtures, record before saving a baseline.
+# recorded.json notes what was recorded, bench/run.py copies it into its reports and compares it with the baseline's.
+# resume_malformed.html isn't recorded, it's kept by hand for the backend agreement check.
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64)'}
+
+async def record(query):
+    async with httpx.AsyncClient(http2=True, follow_redirects=True, headers=HEADERS, timeout=30.0) as client:
+        r = await client.get(f'https://api.hh.ru/vacancies?page=0&per_page=20&text={query}')
+        r.raise_for_status()
+        with open(os.path.join(FIXTURES, 'vacancies.json'), 'w', encoding='utf-8') as f:
+            json.dump(r.json(), f, ensure_ascii=False, indent=1)
+
+        r = await client.get(f'https://hh.ru/search/resume?page=0&text={query}&logic=normal&pos=full_text&exp_period=all_time')
+        r.raise_for_status()
+        with open(os.path.join(FIXTURES, 'serp.html'), 'wb') as f:
+            f.write(r.content)
+
+        links = parse_resume_links(r.content, 'html.parser', r.encoding) or []
+        if len(links) < 2:
+            sys.exit('Not enough resume links on the search page')
+
+        # The first result usually fills most blocks, the last one of the page fewer
+        for name, link in (('resume_full', links[0]), ('resume_sparse', links[-1])):
+            r = await client.get('https://hh.ru' + link)
+            r.raise_for_status()
+            with open(os.path.join(FIXTURES, f'{name}.html'), 'wb') as f:
+                f.write(r.content)
+
+    with open(os.path.join(FIXTURES, 'recorded.json'), 'w', encoding='utf-8') as f:
+        json.dump({'query': query, 'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                   'resumes': [links[0], links[-1]]}, f, ensure_ascii=False, indent=1)
+
+if __name__ == '__main__':
+    asyncio.run(record(sys.argv[1] if len(sys.argv) > 1 else 'python'))
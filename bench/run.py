@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+from copy import deepcopy
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+from src.extract import ResumeExtractor, parse_resume, parse_resume_links, available_backend
+from src.parse import ParserInstance
+
+# Offline benchmarks over the recorded pages in bench/fixtures (record them with bench/record.py, which also writes
+# bench/fixtures/recorded.json, a baseline is only saved over recorded pages).
+# Run from the repository root:
+#   python -m bench.run                                   prints and writes bench/results.json
+#   python -m bench.run --baseline bench/baseline.json    also flags results that got worse than the tolerance
+#   python -m bench.run --save-baseline                   stores the results as the new baseline
+# The database benchmarks create and drop '<db_name>_bench' next to the configured database, skipped if it's unreachable.
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def fixture(name, mode='rb'):
+    with open(os.path.join(FIXTURES, name), mode) as f:
+        return f.read()
+
+def recorded(): # What bench/record.py stored, None while the fixtures are the hand-written stand-ins
+    try:
+        return json.loads(fixture('recorded.json'))
+    except FileNotFoundError:
+        return None
+
+def measure(function, min_time=0.2, repeat=5): # Seconds per call, median of the repeats
+    calls = 1
+    while True: # Calls per repeat so a repeat lasts about min_time
+        started = perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = perf_counter() - started
+        if elapsed >= min_time:
+            break
+        calls = max(calls * 2, int(calls * min_time / max(elapsed, 1e-9)))
+
+    times = [elapsed / calls]
+    for _ in range(repeat - 1):
+        started = perf_counter()
+        for _ in range(calls):
+            function()
+        times.append((perf_counter() - started) / calls)
+    return statistics.median(times)
+
+def result(value, unit, higher_is_better=True):
+    return {'value': round(value, 3), 'unit': unit, 'higher_is_better': higher_is_better}
+
+def bench_parser(results):
+    pages = {name: fixture(f'{name}.html') for name in ('resume_full', 'resume_sparse')}
+    serp = fixture('serp.html')
+
+    for backend in ('lxml', 'html.parser'):
+        if available_backend(backend) != backend:
+            continue
+
+        for name, html in pages.items():
+            seconds = measure(lambda: parse_resume(html, backend))
+            results[f'parser.{backend}.{name}.pages_per_s'] = result(1 / seconds, 'pages/s')
+
+            # Stages of one page: building the tree, the data-qa index pass, reading the fields off the index
+            soup = BeautifulSoup(html, backend)
+            extractor = ResumeExtractor(soup)
+            results[f'parser.{backend}.{name}.soup_us'] = result(measure(lambda: BeautifulSoup(html, backend)) * 1e6, 'us', False)
+            results[f'parser.{backend}.{name}.index_us'] = result(measure(lambda: ResumeExtractor(soup)) * 1e6, 'us', False)
+            results[f'parser.{backend}.{name}.fields_us'] = result(measure(extractor.params) * 1e6, 'us', False)
+
+        seconds = measure(lambda: parse_resume_links(serp, backend))
+        results[f'parser.{backend}.serp.pages_per_s'] = result(1 / seconds, 'pages/s')
+
+    if available_backend('lxml') == 'lxml': # The backends repair broken markup differently, a speedup is no use if the fields change
+        # resume_malformed.html is kept by hand, it holds the unclosed and misnested tags the two are known to disagree on
+        pages['resume_malformed'] = fixture('resume_malformed.html')
+        disagreements = 0
+        for name, html in pages.items():
+            fields, reference = parse_resume(html, 'lxml'), parse_resume(html, 'html.parser')
+            for field in fields:
+                if fields[field] != reference[field]:
+                    print(f'{name}: {field} is {fields[field]!r} with lxml, {reference[field]!r} with html.parser', file=sys.stderr)
+                    disagreements += 1
+        if parse_resume_links(serp, 'lxml') != parse_resume_links(serp, 'html.parser'):
+            print('serp: the resume links differ between lxml and html.parser', file=sys.stderr)
+            disagreements += 1
+        results['parser.backend_disagreements'] = result(disagreements, 'fields', False)
+
+def bench_vacancies(results):
+    items = json.loads(fixture('vacancies.json'))['items']
+    parser = ParserInstance.__new__(ParserInstance) # Mapping needs no configuration
+    get_params = parser._ParserInstance__get_vacancy_params
+
+    seconds = measure(lambda: [get_params(item) for item in items])
+    results['vacancies.mapping.items_per_s'] = result(len(items) / seconds, 'items/s')
+
+    seconds = measure(lambda: [get_params(item) for item in json.loads(fixture('vacancies.json'))['items']])
+    results['vacancies.decode_and_mapping.pages_per_s'] = result(1 / seconds, 'pages/s')
+
+def bench_db(results, config, rows):
+    from sqlalchemy_utils import drop_database
+    from src.db import DatabaseWorker
+    from src.main import vacancy_row, resume_row
+
+    config = dict(config, db_name=config['db_name'] + '_bench')
+    db = DatabaseWorker(config)
+    try:
+        db.setup()
+    except Exception as exc:
+        print(f'Skipping database benchmarks: {exc}', file=sys.stderr)
+        return
+
+    try:
+        items = json.loads(fixture('vacancies.json'))['items']
+        get_params = ParserInstance.__new__(ParserInstance)._ParserInstance__get_vacancy_params
+        vacancies = []
+        for i in range(rows):
+            vacancy = vacancy_row(get_params(items[i % len(items)]))
+            vacancies.append(dict(vacancy, id=str(100000000 + i), average_salary=(vacancy['average_salary'] or 0) + i % 1000 or None))
+
+        resume = parse_resume(fixture('resume_full.html'), available_backend('lxml'))
+        resumes = [resume_row(dict(deepcopy(resume), id=f'{i:038x}', salary=50000 + i * 10)) for i in range(rows // 4)]
+
+        size = config['batch_size']
+        def upsert(write, rows):
+            started = perf_counter()
+            for i in range(0, len(rows), size):
+                write(rows[i:i + size])
+            return len(rows) / (perf_counter() - started)
+
+        results['db.vacancies.insert_rows_per_s'] = result(upsert(db.add_vacancies, vacancies), 'rows/s')
+        results['db.vacancies.update_rows_per_s'] = result(upsert(db.add_vacancies, vacancies), 'rows/s')
+        results['db.resumes.insert_rows_per_s'] = result(upsert(db.add_resumes, resumes), 'rows/s')
+        results['db.resumes.update_rows_per_s'] = result(upsert(db.add_resumes, resumes), 'rows/s')
+
+        filtered = json.dumps({'area': [{'op': 'eq', 'value': 'Москва'}], 'average_salary': [{'op': 'range', 'min': 100000, 'ordering': 'desc'}]})
+        results['db.vacancies.filtered_page_per_s'] = result(1 / measure(lambda: db.get_vacancies_table(0, 100, filtered)), 'queries/s')
+        results['db.vacancies.deep_offset_page_per_s'] = result(1 / measure(lambda: db.get_vacancies_table(rows // 100 - 1, 100, '{}')), 'queries/s')
+        results['db.vacancies.search_page_per_s'] = result(1 / measure(lambda: db.search_vacancies('python', 0, 20, '{}')), 'queries/s')
+
+        skills = json.dumps({'skills': [{'op': 'all', 'value': ['Python', 'Docker']}]})
+        results['db.resumes.skills_page_per_s'] = result(1 / measure(lambda: db.get_resumes_table(0, 100, skills)), 'queries/s')
+
+        def scan():
+            cursor, count = '', 0
+            while cursor is not None:
+                page, cursor = db.get_vacancies_after(cursor, 500, '{}')
+                count += len(page)
+            return count
+
+        started = perf_counter()
+        count = scan()
+        results['db.vacancies.keyset_scan_rows_per_s'] = result(count / (perf_counter() - started), 'rows/s')
+    finally:
+        db.engine.dispose()
+        drop_database(db.engine.url)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous or not previous['value']:
+            continue
+
+        change = (current['value'] - previous['value']) / previous['value']
+        worse = -change if current['higher_is_better'] else change
+        flag = 'REGRESSION' if worse > tolerance else ''
+        print(f'{name:55} {previous["value"]:>12} -> {current["value"]:>12} {current["unit"]:9} {change:+7.1%} {flag}')
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    arguments = argparse.ArgumentParser(description='Offline benchmarks of parsing, mapping and database access')
+    arguments.add_argument('--only', default='parser,vacancies,db', help='comma-separated groups: parser, vacancies, db')
+    arguments.add_argument('--db-config', default='db_config.json')
+    arguments.add_argument('--rows', type=int, default=5000, help='vacancy rows for the database benchmarks, a quarter as many resumes')
+    arguments.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'results.json'))
+    arguments.add_argument('--baseline', default=None)
+    arguments.add_argument('--save-baseline', action='store_true')
+    arguments.add_argument('--tolerance', type=float, default=0.15, help='relative change counted as a regression')
+    args = arguments.parse_args()
+
+    groups, results = args.only.split(','), {}
+    if 'parser' in groups:
+        bench_parser(results)
+    if 'vacancies' in groups:
+        bench_vacancies(results)
+    if 'db' in groups:
+        with open(args.db_config) as f:
+            bench_db(results, json.load(f), args.rows)
+
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'fixtures': recorded(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    baseline_path = args.baseline or os.path.join(os.path.dirname(__file__), 'baseline.json')
+    if args.save_baseline:
+        if report['fixtures'] is None:
+            sys.exit('The fixtures are the hand-written stand-ins, record real pages with python -m bench.record first')
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('fixtures') != report['fixtures']:
+            print('The baseline was measured on other fixtures, the comparison is meaningless', file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s) beyond {args.tolerance:.0%}')
+            sys.exit(1)
+    else:
+        for name, current in sorted(results.items()):
+            print(f'{name:55} {current["value"]:>12} {current["unit"]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import asyncio
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+# Stand-in for api.hh.ru/vacancies, hh.ru/search/resume and hh.ru/resume/<id>, serving the benchmark fixtures.
+# Every response waits for a log-normal delay and fails with the configured probabilities:
+#   python -m loadtest.mock_upstream --port 8100 --latency-median 0.15 --latency-p99 1.0 --error-rate 0.01 --throttle-rate 0.01
+# Results differ per query and page, so the app's cache and the database see distinct rows.
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'bench', 'fixtures')
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+def create_app(latency_median, latency_p99, error_rate, throttle_rate, found):
+    app = FastAPI()
+    vacancies = json.loads(fixture('vacancies.json'))['items']
+    resume = fixture('resume_full.html')
+    serp = fixture('serp.html') # Only pads the generated results to a real page's size
+
+    mu = math.log(latency_median)
+    sigma = max(math.log(latency_p99 / latency_median) / 2.326, 0.0) # z of the 99th percentile
+
+    async def upstream():
+        await asyncio.sleep(random.lognormvariate(mu, sigma))
+        draw = random.random()
+        if draw < throttle_rate:
+            return Response(status_code=429, headers={'Retry-After': '1'})
+        if draw < throttle_rate + error_rate:
+            return Response(status_code=random.choice((500, 502, 503)))
+        return None
+
+    def ids(*key, count):
+        seed = hashlib.sha1(repr(key).encode()).hexdigest()
+        return [hashlib.sha1(f'{seed}{i}'.encode()).hexdigest() for i in range(count)]
+
+    @app.get('/vacancies')
+    async def get_vacancies(request: Request, page: int=0, per_page: int=20):
+        failure = await upstream()
+        if failure:
+            return failure
+        if (page + 1) * per_page > 2000:
+            return Response(status_code=400, content=b'{"errors": [{"type": "bad_argument", "value": "page"}]}')
+
+        count = max(0, min(per_page, found - page * per_page))
+        items = []
+        for i, id in enumerate(ids(str(request.query_params.get('text')), page, per_page, count=count)):
+            item = dict(vacancies[i % len(vacancies)], id=str(int(id[:8], 16) % 10**9)) # Fits the 9 characters of real ids
+            items.append(item)
+        return {'items': items, 'found': found, 'pages': min(math.ceil(found / per_page), 2000 // per_page), 'per_page': per_page, 'page': page}
+
+    @app.get('/search/resume')
+    async def search_resumes(request: Request, page: int=0, items_on_page: int=20):
+        failure = await upstream()
+        if failure:
+            return failure
+
+        count = max(0, min(items_on_page, found - page * items_on_page))
+        links = ''.join(f'<a class="bloko-link" href="/resume/{id[:38]}?query=x">Резюме</a>\n'
+                        for id in ids(str(request.query_params.get('text')), page, items_on_page, count=count))
+        html = f'<html><body><div data-qa="resume-serp__results-search">\n{links}</div>\n'.encode() + serp + b'</body></html>'
+        return Response(html, media_type='text/html; charset=utf-8')
+
+    @app.get('/resume/{id}')
+    async def get_resume(id: str):
+        failure = await upstream()
+        if failure:
+            return failure
+        return Response(resume, media_type='text/html; charset=utf-8')
+
+    return app
+
+def main():
+    arguments = argparse.ArgumentParser(description='Mock hh.ru upstream for load tests')
+    arguments.add_argument('--host', default='127.0.0.1')
+    arguments.add_argument('--port', type=int, default=8100)
+    arguments.add_argument('--latency-median', type=float, default=0.15, help='seconds')
+    arguments.add_argument('--latency-p99', type=float, default=1.0, help='seconds')
+    arguments.add_argument('--error-rate', type=float, default=0.0, help='share of 5xx responses')
+    arguments.add_argument('--throttle-rate', type=float, default=0.0, help='share of 429 responses')
+    arguments.add_argument('--found', type=int, default=2000, help='results per query')
+    args = arguments.parse_args()
+
+    app = create_app(args.latency_median, args.latency_p99, args.error_rate, args.throttle_rate, args.found)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+
+import httpx
+
+# Drives the app with concurrent clients against loadtest/mock_upstream.py and reports per endpoint throughput and
+# p50/p95/p99 latency, plus how long scraped rows take to become readable through /db (the writer queue lag).
+# Run from the repository root, MySQL from db_config.json has to be reachable:
+#   python -m loadtest.run --clients 200 --duration 60 --workers 4 --latency-median 0.2 --error-rate 0.02
+# The app is started in a scratch directory with its configuration pointed at the mock, or use --app-url to load
+# an already running one (its parse_config.json then has to point at the mock itself).
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXTS = ('python', 'java', 'golang', 'devops', 'analyst', 'designer', 'manager', 'qa', 'frontend', 'data')
+
+def endpoints(): # name -> function returning the path and query of a request
+    def search_vacancies():
+        return '/search/vacancies', {'text': random.choice(TEXTS), 'page': random.randrange(10)}
+    def search_vacancies_limit():
+        return '/search/vacancies', {'text': random.choice(TEXTS), 'limit': 200}
+    def search_resumes():
+        return '/search/resumes', {'text': random.choice(TEXTS), 'page': random.randrange(10)}
+    def search_resumes_deadline():
+        return '/search/resumes', {'text': random.choice(TEXTS), 'page': random.randrange(10), 'deadline': 2.0}
+    def db_vacancies():
+        return '/db/vacancies', {'page': random.randrange(50), 'limit': 20}
+    def db_vacancies_filtered():
+        filter = {'average_salary': [{'op': 'range', 'min': random.randrange(0, 200000, 10000), 'ordering': 'desc'}]}
+        return '/db/vacancies', {'limit': 20, 'cursor': '', 'filter': json.dumps(filter)}
+    def db_vacancies_search():
+        return '/db/vacancies/search', {'q': random.choice(TEXTS)}
+    def db_resumes():
+        return '/db/resumes', {'page': random.randrange(50), 'limit': 20}
+
+    return {function.__name__: function for function in (search_vacancies, search_vacancies_limit, search_resumes, search_resumes_deadline,
+                                                         db_vacancies, db_vacancies_filtered, db_vacancies_search, db_resumes)}
+
+class Report:
+    def __init__(self):
+        self.latencies = {} # endpoint -> seconds
+        self.statuses = {} # endpoint -> {status: count}
+        self.lags = {'vacancies': [], 'resumes': []} # seconds until a scraped row was readable
+        self.lag_timeouts = 0
+        self.queue = {'queued_rows': 0, 'spilled_bytes': 0} # Peaks
+
+    def record(self, endpoint, status, latency):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        statuses = self.statuses.setdefault(endpoint, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def summary(self, duration):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            ok = sum(count for status, count in self.statuses[endpoint].items() if status == 200)
+            endpoints[endpoint] = dict(requests=len(latencies), rps=round(len(latencies) / duration, 2), ok=ok,
+                                       statuses=self.statuses[endpoint], **percentiles(latencies))
+        lags = {kind: percentiles(lags) for kind, lags in self.lags.items() if lags}
+        return {'duration': duration, 'endpoints': endpoints, 'writer_lag': lags, 'lag_timeouts': self.lag_timeouts, 'queue_peak': self.queue}
+
+def percentiles(values): # Milliseconds, nearest rank
+    values = sorted(values)
+    rank = lambda share: values[max(0, math.ceil(share * len(values)) - 1)] * 1000
+    return {'p50_ms': round(rank(0.5), 1), 'p95_ms': round(rank(0.95), 1), 'p99_ms': round(rank(0.99), 1), 'max_ms': round(values[-1] * 1000, 1)}
+
+async def client(http, report, mix, deadline, lag_sample, lag_tasks):
+    names, weights = zip(*mix.items())
+    paths = endpoints()
+
+    while monotonic() < deadline:
+        endpoint = random.choices(names, weights)[0]
+        started = monotonic()
+        try:
+            path, params = paths[endpoint]()
+            r = await http.get(path, params=params)
+            status = r.status_code
+        except httpx.HTTPError as exc:
+            r, status = None, type(exc).__name__
+        report.record(endpoint, status, monotonic() - started)
+
+        if status == 200 and endpoint.startswith('search_') and random.random() < lag_sample:
+            items = r.json()
+            if items:
+                kind = 'resumes' if endpoint.startswith('search_resumes') else 'vacancies'
+                lag_tasks.append(asyncio.create_task(measure_lag(http, report, kind, random.choice(items)['id'])))
+
+async def measure_lag(http, report, kind, id, timeout=60.0):
+    started = monotonic()
+    params = {'limit': 1, 'filter': json.dumps({'id': [{'op': 'eq', 'value': id}]})}
+    while monotonic() - started < timeout:
+        try:
+            r = await http.get(f'/db/{kind}', params=params)
+            if r.status_code == 200 and r.json():
+                report.lags[kind].append(monotonic() - started)
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.05)
+    report.lag_timeouts += 1
+
+async def watch_queue(http, report, deadline):
+    while monotonic() < deadline:
+        try:
+            depth = (await http.get('/db/queue')).json()
+            for kind in ('resumes', 'vacancies'):
+                report.queue['queued_rows'] = max(report.queue['queued_rows'], depth[kind]['queued_rows'])
+                report.queue['spilled_bytes'] = max(report.queue['spilled_bytes'], depth[kind]['spilled_bytes'])
+        except (httpx.HTTPError, KeyError, ValueError):
+            pass
+        await asyncio.sleep(1.0)
+
+async def load(url, clients, duration, warmup, mix, lag_sample):
+    limits = httpx.Limits(max_connections=clients + 20, max_keepalive_connections=clients + 20)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120.0) as http:
+        if warmup:
+            await asyncio.gather(*[client(http, Report(), mix, monotonic() + warmup, 0, []) for _ in range(clients)])
+
+        report, lag_tasks = Report(), []
+        started = monotonic()
+        deadline = started + duration
+        await asyncio.gather(watch_queue(http, report, deadline),
+                             *[client(http, report, mix, deadline, lag_sample, lag_tasks) for _ in range(clients)])
+        duration = monotonic() - started
+        await asyncio.gather(*lag_tasks) # Rows of the last requests still have to land
+        return report.summary(duration)
+
+def start_app(args, directory):
+    with open(args.db_config) as f:
+        db_config = json.load(f)
+    with open(os.path.join(ROOT, 'parse_config.json')) as f:
+        parse_config = json.load(f)
+
+    # Distinct host names keep the governor's per-host limits apart, both reach the same mock
+    parse_config.update(api_url=f'http://127.0.0.1:{args.mock_port}', site_url=f'http://localhost:{args.mock_port}', crawl_enabled=False)
+    if not args.production_limits:
+        unlimited = {'rate': 100000.0, 'burst': 100000, 'min_concurrency': 1000, 'max_concurrency': 1000, 'latency_target': 60.0}
+        parse_config['upstream_hosts'] = {'*': unlimited}
+    else:
+        hosts = parse_config['upstream_hosts']
+        parse_config['upstream_hosts'] = {'127.0.0.1': hosts['api.hh.ru'], 'localhost': hosts['hh.ru'], '*': hosts['*']}
+
+    for name, config in (('db_config.json', db_config), ('parse_config.json', parse_config)):
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(config, f, indent=4)
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.Popen([sys.executable, '-m', 'uvicorn', 'src.main:app', '--port', str(args.port), '--workers', str(args.workers),
+                             '--log-level', 'warning'], cwd=directory, env=env)
+
+def start_mock(args):
+    return subprocess.Popen([sys.executable, '-m', 'loadtest.mock_upstream', '--port', str(args.mock_port),
+                             '--latency-median', str(args.latency_median), '--latency-p99', str(args.latency_p99),
+                             '--error-rate', str(args.error_rate), '--throttle-rate', str(args.throttle_rate)], cwd=ROOT)
+
+def wait_ready(url, process, timeout=60.0):
+    started = monotonic()
+    while monotonic() - started < timeout:
+        if process and process.poll() is not None:
+            sys.exit(f'{url} exited with {process.returncode}')
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        sleep(0.2)
+    sys.exit(f'{url} didn\'t start in {timeout} seconds')
+
+def stop(process):
+    if process and process.poll() is None:
+        process.send_signal(signal.SIGINT) # Lets the app drain its writer queues
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def main():
+    arguments = argparse.ArgumentParser(description='Load test of the API against a mock upstream')
+    arguments.add_argument('--clients', type=int, default=100, help='concurrent clients, each sends its next request once answered')
+    arguments.add_argument('--duration', type=float, default=60.0, help='seconds')
+    arguments.add_argument('--warmup', type=float, default=5.0, help='seconds, not reported')
+    arguments.add_argument('--mix', default='search_vacancies=3,search_vacancies_limit=1,search_resumes=1,db_vacancies=3,db_vacancies_filtered=2,db_vacancies_search=1,db_resumes=2',
+                           help='endpoint=weight, endpoints: ' + ', '.join(endpoints()))
+    arguments.add_argument('--lag-sample', type=float, default=0.05, help='share of search responses whose rows are traced into /db')
+    arguments.add_argument('--app-url', default=None, help='load a running app instead of starting one')
+    arguments.add_argument('--port', type=int, default=8200)
+    arguments.add_argument('--workers', type=int, default=1)
+    arguments.add_argument('--db-config', default=os.path.join(ROOT, 'db_config.json'))
+    arguments.add_argument('--production-limits', action='store_true', help='keep the governor limits of parse_config.json')
+    arguments.add_argument('--mock-port', type=int, default=8100)
+    arguments.add_argument('--latency-median', type=float, default=0.15)
+    arguments.add_argument('--latency-p99', type=float, default=1.0)
+    arguments.add_argument('--error-rate', type=float, default=0.0)
+    arguments.add_argument('--throttle-rate', type=float, default=0.0)
+    arguments.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'results.json'))
+    args = arguments.parse_args()
+
+    mix = {}
+    for entry in args.mix.split(','):
+        name, _, weight = entry.partition('=')
+        if name not in endpoints():
+            sys.exit(f'Unknown endpoint {name}')
+        mix[name] = float(weight or 1)
+
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    mock, app = start_mock(args), None
+    try:
+        wait_ready(f'http://127.0.0.1:{args.mock_port}/vacancies?per_page=1', mock)
+        url = args.app_url
+        if not url:
+            app = start_app(args, directory)
+            url = f'http://127.0.0.1:{args.port}'
+            wait_ready(url + '/', app)
+
+        summary = asyncio.run(load(url, args.clients, args.duration, args.warmup, mix, args.lag_sample))
+        summary['settings'] = {name: value for name, value in vars(args).items() if name not in ('output', 'db_config')}
+    finally:
+        stop(app)
+        stop(mock)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    print(f'{"endpoint":24} {"requests":>9} {"rps":>8} {"ok":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for endpoint, stats in summary['endpoints'].items():
+        print(f'{endpoint:24} {stats["requests"]:>9} {stats["rps"]:>8} {stats["ok"]:>7} {stats["p50_ms"]:>9} {stats["p95_ms"]:>9} {stats["p99_ms"]:>9} {stats["max_ms"]:>9}')
+    for kind, lag in summary['writer_lag'].items():
+        print(f'writer lag {kind:13} p50 {lag["p50_ms"]} ms, p95 {lag["p95_ms"]} ms, p99 {lag["p99_ms"]} ms, max {lag["max_ms"]} ms')
+    print(f'lag timeouts {summary["lag_timeouts"]}, queue peak {summary["queue_peak"]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+from src.tracing import span
+
+class ResultCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl # Seconds per endpoint, e.g. {'vacancies': 300, 'resumes': 600}
+
+        self.entries = OrderedDict() # key -> (expires_at, value), oldest first
+        self.pending = {} # key -> running fetch task, shared by concurrent misses
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, endpoint, fetch, **params):
+        key = ResultCache.make_key(endpoint, params)
+
+        with span('cache', endpoint=endpoint) as traced:
+            entry = self.entries.get(key)
+            if entry:
+                if entry[0] > monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    traced.set(outcome='hit')
+                    return entry[1]
+                del self.entries[key]
+
+            task = self.pending.get(key)
+            if task:
+                self.coalesced += 1
+                traced.set(outcome='coalesced') # The fetch's spans are in the trace of the request that started it
+            else:
+                self.misses += 1
+                traced.set(outcome='miss')
+                task = asyncio.ensure_future(fetch(**params)) # Copies the context, so the fetch's spans nest in this one
+                task.add_done_callback(lambda task: self.__store(key, endpoint, task))
+                self.pending[key] = task
+
+            return await asyncio.shield(task) # A cancelled waiter doesn't cancel the fetch for the others
+
+    async def refresh(self, endpoint, fetch, **params): # Fetches anew even if cached, the result replaces the entry
+        self.entries.pop(ResultCache.make_key(endpoint, params), None)
+        return await self.get(endpoint, fetch, **params)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'pending': len(self.pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+    def clear(self):
+        self.entries.clear()
+
+    def __store(self, key, endpoint, task):
+        self.pending.pop(key, None)
+
+        if task.cancelled() or task.exception() or not task.result(): # Failed and empty results are not cached
+            return
+
+        self.entries[key] = (monotonic() + self.ttl[endpoint], task.result())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def make_key(endpoint, params):
+        normalized = []
+        for name in sorted(params):
+            value = params[name]
+            if isinstance(value, str):
+                value = ' '.join(value.lower().split())
+                if name in ('schedule', 'employment', 'experience'):
+                    value = ','.join(sorted(set(filter(None, value.replace(' ', '').split(',')))))
+                value = value or None
+            normalized.append((name, value))
+
+        return (endpoint, tuple(normalized))
@@ -0,0 +1,118 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+
+# Periodically runs the configured queries so their results are stored and cached before anyone asks.
+# A query: {"kind": "vacancies" | "resumes", "params": {...search params}, "pages": [first, last], "interval": seconds}
+# Vacancy queries with "mode": "incremental" fetch only what was published since their previous sync instead of pages.
+
+class Crawler:
+    kinds = ('vacancies', 'resumes')
+
+    def __init__(self, config, fetch, sync, record):
+        self.interval = config['crawl_interval']
+        self.jitter = config['crawl_jitter']
+        self.concurrency = config['crawl_concurrency']
+        self.queries = {}
+        for query in config['crawl_queries']:
+            if query['kind'] not in Crawler.kinds:
+                raise ValueError(f'Unknown crawl kind {query["kind"]}')
+            if query.get('mode', 'pages') not in ('pages', 'incremental') or query.get('mode') == 'incremental' and query['kind'] != 'vacancies':
+                raise ValueError(f'Unknown crawl mode {query["mode"]} for {query["kind"]}')
+            self.queries[Crawler.query_key(query)] = query
+
+        self.fetch = fetch # async (kind, page=..., **params) -> list or None
+        self.sync = sync # async (query key, **params) -> list of new items or None
+        self.record = record # async (run) -> None, persists the last run of a query
+        self.scheduler = None
+        self.semaphore = None
+        self.runs = {} # query key -> last run
+
+    def start(self, last_runs={}):
+        self.semaphore = asyncio.Semaphore(self.concurrency) # Shared by every query, caps upstream pages in flight
+        self.scheduler = AsyncIOScheduler()
+
+        now = datetime.now()
+        for key, query in self.queries.items():
+            interval = query.get('interval', self.interval)
+
+            # Continues the schedule of the previous process, overdue queries run shortly after startup
+            start = now
+            if key in last_runs:
+                self.runs[key] = last_runs[key]
+                start = max(now, last_runs[key]['finished_at'] + timedelta(seconds=interval))
+            start += timedelta(seconds=random.uniform(0, self.jitter)) # Spreads the first runs too
+
+            self.scheduler.add_job(self.run, IntervalTrigger(seconds=interval, start_date=start, jitter=self.jitter), args=(key, query),
+                                   id=key, max_instances=1, coalesce=True, misfire_grace_time=None)
+
+        self.scheduler.start()
+
+    def stop(self):
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+
+    async def run(self, key, query):
+        first, last = query.get('pages', [0, 0])
+        started_at = datetime.now()
+
+        if query.get('mode') == 'incremental':
+            async with self.semaphore:
+                try:
+                    results = [await self.sync(key, **query.get('params', {}))]
+                except Exception as exc:
+                    print(f'Error syncing {key}: ', exc)
+                    results = [None]
+            return await self.finish(key, query, started_at, results)
+
+        async def fetch_page(page):
+            async with self.semaphore:
+                try:
+                    return await self.fetch(query['kind'], page=page, **query.get('params', {}))
+                except Exception as exc:
+                    print(f'Error crawling {key} page {page}: ', exc)
+                    return None
+
+        results = await asyncio.gather(*[fetch_page(page) for page in range(first, last + 1)])
+        await self.finish(key, query, started_at, results)
+
+    async def finish(self, key, query, started_at, results):
+        run = {
+            'query': key,
+            'kind': query['kind'],
+            'started_at': started_at,
+            'finished_at': datetime.now(),
+            'pages': len(results),
+            'failed_pages': sum(1 for result in results if result is None),
+            'items': sum(len(result) for result in results if result),
+        }
+        self.runs[key] = run
+
+        try:
+            await self.record(run)
+        except Exception as exc:
+            print('Error recording crawl run: ', exc)
+
+    def status(self):
+        jobs = {job.id: job for job in self.scheduler.get_jobs()} if self.scheduler else {}
+
+        status = []
+        for key in self.queries:
+            job = jobs.get(key)
+            status.append({
+                'query': key,
+                'last_run': self.runs.get(key),
+                'next_run': job.next_run_time if job else None,
+            })
+        return status
+
+    def query_key(query): # Stable name of a query, the last run is stored under it
+        params = sorted((name, value) for name, value in query.get('params', {}).items() if value is not None)
+        if query.get('mode') == 'incremental':
+            return f'{query["kind"]}?{urlencode(params)}&mode=incremental'[:255]
+        return f'{query["kind"]}?{urlencode(params)}&pages={"-".join(map(str, query.get("pages", [0, 0])))}'[:255]
@@ -1,40 +1,56 @@
-from sqlalchemy import Table, Column, Integer, MetaData, Text, text, create_engine
+from sqlalchemy import Table, Column, Index, Integer, DateTime, MetaData, Text, text, select, func, inspect, create_engine
 from sqlalchemy.dialects.mysql import VARCHAR, MEDIUMTEXT, JSON, TINYTEXT, CHAR, insert
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy_utils import database_exists, create_database
 
-from json import loads
+from src.parse import ParserInstance
+from src.filters import FilterEngine
+from src.structs import Resume, Vacancy
+
+from json import loads, dumps
+from datetime import datetime, timezone
 from copy import deepcopy
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+# List fields of resumes that are also stored as (resume_id, value) rows in 'resume_<field>' tables
+RESUME_SETS = ('skills', 'languages', 'specializations')
+
+# Low-cardinality vacancy fields are also stored as hh.ru ids in indexed '<field>_id' columns
+ENUM_IDS = {
+    'schedule': {entry['name'].lower(): entry['id'] for entry in ParserInstance.schedule_dict},
+    'experience': {entry['name'].lower(): entry['id'] for entry in ParserInstance.experience_dict},
+    'employment': {entry['name'].lower(): entry['id'] for entry in ParserInstance.employment_dict},
+}
 
 class DatabaseWorker:
     def __init__(self, config):
         self.engine = create_engine(f'mysql+mysqlconnector://{config["user"]}:{config["password"]}@{config["hostname"]}:{config["port"]}/{config["db_name"]}?charset=utf8mb4', echo=config["debug"])
 
-        if not database_exists(self.engine.url):
-            create_database(self.engine.url, encoding='utf8mb4')
-
         self.metadata = MetaData()
         self.resumes_table = Table (
             'resumes',
             self.metadata,
             Column('id', VARCHAR(38), primary_key=True, unique=True),
-            Column('gender', TINYTEXT),
-            Column('age', Integer),
+            Column('gender', VARCHAR(16), index=True),
+            Column('age', Integer, index=True),
             Column('birthday',  MEDIUMTEXT),
             Column('search_status', MEDIUMTEXT),
             Column('address', MEDIUMTEXT),
             Column('position', MEDIUMTEXT),
             Column('specializations', JSON),
             Column('about', Text),
-            Column('salary', Integer),
-            Column('currency', TINYTEXT),
+            Column('salary', Integer, index=True),
+            Column('currency', VARCHAR(8), index=True),
             Column('preferred_commute_time', MEDIUMTEXT),
             Column('skills', JSON),
-            Column('employment', MEDIUMTEXT),
+            Column('employment', JSON),
             Column('moving_status', MEDIUMTEXT),
             Column('citizenship', MEDIUMTEXT),
             Column('languages', JSON),
             Column('education', JSON),
-            Column('schedule', MEDIUMTEXT),
+            Column('schedule', JSON),
+            Column('scraped_at', DateTime),
+            Index('ft_resumes_text', 'position', 'about', mysql_prefix='FULLTEXT'),
         )
 
         self.vacancies_table = Table (
@@ -42,9 +58,9 @@ class DatabaseWorker:
             self.metadata,
             Column('id', VARCHAR(9), primary_key=True, unique=True),
             Column('name', MEDIUMTEXT),
-            Column('area', MEDIUMTEXT),
-            Column('average_salary',  Integer),
-            Column('currency',  TINYTEXT),
+            Column('area', VARCHAR(255), index=True),
+            Column('average_salary',  Integer, index=True),
+            Column('currency',  VARCHAR(8), index=True),
             Column('type', MEDIUMTEXT),
             Column('employer', MEDIUMTEXT),
             Column('requirement', Text),
@@ -52,112 +68,256 @@ class DatabaseWorker:
             Column('schedule', MEDIUMTEXT),
             Column('experience', MEDIUMTEXT),
             Column('employment', MEDIUMTEXT),
+            Column('schedule_id', VARCHAR(16), index=True),
+            Column('experience_id', VARCHAR(16), index=True),
+            Column('employment_id', VARCHAR(16), index=True),
+            Index('ft_vacancies_text', 'name', 'requirement', 'responsibility', mysql_prefix='FULLTEXT'),
+        )
+
+        # Inverted indexes over the resumes' list fields, kept in sync by add_resumes
+        self.resume_sets = {}
+        for field in RESUME_SETS:
+            self.resume_sets[field] = Table (
+                f'resume_{field}',
+                self.metadata,
+                Column('resume_id', VARCHAR(38), primary_key=True),
+                Column('value', VARCHAR(255), primary_key=True),
+                Index(f'ix_resume_{field}_value', 'value', 'resume_id'),
+            )
+
+        # Last run of every scheduled crawl query, the schedule continues from it after a restart
+        self.crawl_runs_table = Table (
+            'crawl_runs',
+            self.metadata,
+            Column('query', VARCHAR(255), primary_key=True),
+            Column('kind', VARCHAR(16)),
+            Column('started_at', DateTime),
+            Column('finished_at', DateTime),
+            Column('pages', Integer),
+            Column('failed_pages', Integer),
+            Column('items', Integer),
+        )
+
+        # Newest publication time (UTC) seen by every incremental vacancy sync query
+        self.sync_watermarks_table = Table (
+            'sync_watermarks',
+            self.metadata,
+            Column('query', VARCHAR(255), primary_key=True),
+            Column('watermark', DateTime),
+            Column('synced_at', DateTime),
         )
 
+        self.filters = {
+            'resumes': FilterEngine(self.resumes_table, search_columns=('position', 'about'), sets=self.resume_sets, columns=list(Resume.model_fields)),
+            'vacancies': FilterEngine(self.vacancies_table, ENUM_IDS, search_columns=('name', 'requirement', 'responsibility'), columns=list(Vacancy.model_fields)),
+        }
+
+    def setup(self): # Creates and migrates the schema, run by one process at a time (see src/leader.py)
+        if not database_exists(self.engine.url):
+            create_database(self.engine.url, encoding='utf8mb4')
+
+        existing_tables = inspect(self.engine).get_table_names()
         self.metadata.create_all(self.engine)
+        self.__migrate(existing_tables)
 
+    # Rows are plain dicts holding only the API model's fields, ready to be serialized as they are
     def get_vacancies_table(self, page=0, limit=20, filter={}):
         return self.__db_get_rows(page=page, limit=limit, filter=filter, table='vacancies')
 
     def get_resumes_table(self, page=0, limit=20, filter={}):
-        rows = self.__db_get_rows(page=page, limit=limit, filter=filter, table='resumes')
-        result = []
+        return self.__db_get_rows(page=page, limit=limit, filter=filter, table='resumes')
 
-        # Original 'Row Mapping' class seems to reset after the iterator destructs, so the array is rebuilt
-        for row in rows:
-            result.append(dict(row))
+    def search_vacancies(self, query, page=0, limit=20, filter={}):
+        return self.__db_get_rows(page=page, limit=limit, filter=filter, table='vacancies', search=query)
 
-        for row in result:
-            if row['specializations']:
-                row['specializations'] = loads(loads(row['specializations']))
+    def search_resumes(self, query, page=0, limit=20, filter={}):
+        return self.__db_get_rows(page=page, limit=limit, filter=filter, table='resumes', search=query)
 
-            if row['languages']:
-                row['languages'] = loads(loads(row['languages']))
+    def get_vacancies_after(self, cursor='', limit=20, filter={}):
+        return self.__db_get_rows_after(cursor=cursor, limit=limit, filter=filter, table='vacancies')
 
-            if row['education']:   
-                row['education'] = loads(loads(row['education']))
+    def get_resumes_after(self, cursor='', limit=20, filter={}):
+        return self.__db_get_rows_after(cursor=cursor, limit=limit, filter=filter, table='resumes')
 
-            if row['schedule']:
-                row['schedule'] = loads(row['schedule'])
+    def export_rows(self, table, filter='{}', chunk_size=1000):
+        # Chunks seek past the previous one on the index, so a full dump is one pass with a flat memory footprint.
+        # mysql-connector cursors are always buffered, so a single stream_results query would hold the whole result.
+        cursor = ''
+        while True:
+            rows, cursor = self.__db_get_rows_after(cursor=cursor, limit=chunk_size, filter=filter, table=table)
+            yield rows
+            if not cursor:
+                break
 
-            if row['skills']:
-                row['skills'] = loads(loads(row['skills']))
+    def get_fresh_resumes(self, ids, max_age):
+        if not ids:
+            return {}
 
-            if row['employment']:
-                row['employment'] = loads(row['employment'])
+        with self.engine.connect() as connection:
+            select_query = select(self.resumes_table).where(self.resumes_table.c.id.in_(list(ids)),
+                                                            self.resumes_table.c.scraped_at >= func.now() - text(f'INTERVAL {int(max_age)} SECOND'))
+            rows = connection.execute(select_query).mappings().all()
 
-        return result
+        return {row['id']: dict(row) for row in rows}
 
-    def add_vacancy(self, id, name, area, average_salary, currency, type, employer, requirement, responsibility, schedule, experience, employment):
+    def get_crawl_runs(self):
         with self.engine.connect() as connection:
-            insert_query = insert(self.vacancies_table).values (
-                id=id, name=name, area=area, average_salary=average_salary, currency=currency, type=type, employer=employer, 
-                requirement=requirement, responsibility=responsibility, schedule=schedule, experience=experience, employment=employment
-            )
+            rows = connection.execute(select(self.crawl_runs_table)).mappings().all()
 
-            on_duplicate_query = insert_query.on_duplicate_key_update (
-                id=insert_query.inserted.id, name=insert_query.inserted.name, area=insert_query.inserted.area,
-                average_salary=insert_query.inserted.average_salary, currency=insert_query.inserted.currency, type=insert_query.inserted.type, 
-                employer=insert_query.inserted.employer, requirement=insert_query.inserted.requirement, 
-                responsibility=insert_query.inserted.responsibility, schedule=insert_query.inserted.schedule, 
-                experience=insert_query.inserted.experience, employment=insert_query.inserted.employment
-            )
+        return {row['query']: dict(row) for row in rows}
 
-            connection.execute(on_duplicate_query)
-            connection.commit()
+    def record_crawl_run(self, run):
+        with self.engine.begin() as connection:
+            self.__upsert(connection, self.crawl_runs_table, [run])
 
-    def add_resume(self, id, gender, age, birthday, search_status, address, position, specializations, about, salary, currency, preferred_commute_time, skills, employment, moving_status, citizenship, languages, education, schedule):
+    def get_watermark(self, query):
         with self.engine.connect() as connection:
-            insert_query = insert(self.resumes_table).values (
-                id=id, gender=gender, age=age, 
-                birthday=birthday, search_status=search_status, address=address, 
-                position=position, specializations=specializations, about=about, 
-                salary=salary, currency=currency, preferred_commute_time=preferred_commute_time, 
-                skills=skills, employment=employment, moving_status=moving_status, 
-                citizenship=citizenship, languages=languages, education=education,
-                schedule=schedule
-            )
+            watermark = connection.execute(select(self.sync_watermarks_table.c.watermark).where(self.sync_watermarks_table.c.query == query)).scalar()
 
-            on_duplicate_query = insert_query.on_duplicate_key_update (
-                gender=insert_query.inserted.gender, age=insert_query.inserted.age, 
-                birthday=insert_query.inserted.birthday, search_status=insert_query.inserted.search_status, 
-                address=insert_query.inserted.address, position=insert_query.inserted.position, 
-                specializations=insert_query.inserted.specializations, about=insert_query.inserted.about, 
-                salary=insert_query.inserted.salary, currency=insert_query.inserted.currency,
-                preferred_commute_time=insert_query.inserted.preferred_commute_time, 
-                skills=insert_query.inserted.skills, employment=insert_query.inserted.employment, 
-                moving_status=insert_query.inserted.moving_status, 
-                citizenship=insert_query.inserted.citizenship, 
-                languages=insert_query.inserted.languages, education=insert_query.inserted.education,
-                schedule=insert_query.inserted.schedule
-            )
+        if watermark:
+            return watermark.replace(tzinfo=timezone.utc)
+        return None
+
+    def sync_vacancies(self, query, rows, watermark): # The watermark only moves if the rows are committed with it
+        with self.engine.begin() as connection:
+            for i in range(0, len(rows), 1000):
+                self.__upsert(connection, self.vacancies_table, [dict(row, **DatabaseWorker.enum_ids(row)) for row in rows[i:i + 1000]])
+            self.__upsert(connection, self.sync_watermarks_table, [{'query': query,
+                                                                    'watermark': watermark.astimezone(timezone.utc).replace(tzinfo=None),
+                                                                    'synced_at': datetime.now(timezone.utc).replace(tzinfo=None)}])
+
+    def add_vacancy(self, **params):
+        self.add_vacancies([params])
 
-            connection.execute(on_duplicate_query)
+    def add_resume(self, **params):
+        self.add_resumes([params])
+
+    def add_vacancies(self, rows):
+        with self.engine.begin() as connection:
+            self.__upsert(connection, self.vacancies_table, [dict(row, **DatabaseWorker.enum_ids(row)) for row in rows])
+
+    def add_resumes(self, rows):
+        with self.engine.begin() as connection:
+            self.__upsert(connection, self.resumes_table, [dict(row, scraped_at=func.now()) for row in rows])
+            self.__sync_resume_sets(connection, {row['id']: row for row in rows})
+
+    def __upsert(self, connection, table, rows): # One multi-row INSERT ... ON DUPLICATE KEY UPDATE
+        if not rows:
+            return
+
+        insert_query = insert(table).values(rows)
+        on_duplicate_query = insert_query.on_duplicate_key_update (
+            {column.name: insert_query.inserted[column.name] for column in table.columns if column.name in rows[0] and not column.primary_key}
+        )
+        connection.execute(on_duplicate_query)
+
+    def __sync_resume_sets(self, connection, rows): # Replaces the side table rows of every written resume
+        for field, table in self.resume_sets.items():
+            connection.execute(table.delete().where(table.c.resume_id.in_(list(rows))))
+
+            values = []
+            for id, row in rows.items():
+                for value in DatabaseWorker.set_values(row.get(field)):
+                    values.append({'resume_id': id, 'value': value})
+            if values: # Variants the collation still equates (accents, 'ё' and 'е') are dropped by the key, first one wins
+                connection.execute(table.insert().prefix_with('IGNORE'), values)
+
+    def set_values(value):
+        if isinstance(value, str): # Double-encoded rows of older versions
+            value = loads(value)
+
+        unique = {}
+        for item in value or []: # Case-insensitive like the column's collation, first spelling wins (accents are left to the insert)
+            item = str(item).strip()[:255]
+            if item:
+                unique.setdefault(item.casefold(), item)
+        return list(unique.values())
+
+    def enum_ids(row):
+        return {f'{field}_id': ids.get((row.get(field) or '').lower()) for field, ids in ENUM_IDS.items()}
+
+    def __migrate(self, existing_tables): # Brings tables created by older versions up to the current schema
+        existing = inspect(self.engine)
+        with self.engine.connect() as connection:
+            if 'resumes' in existing_tables:
+                columns = {column['name']: column['type'] for column in existing.get_columns('resumes')}
+                if not isinstance(columns['schedule'], JSON): # Rows written before lists were stored natively
+                    self.__unwrap_json(connection)
+
+                for field, table in self.resume_sets.items():
+                    if table.name not in existing_tables:
+                        self.__backfill_resume_set(connection, field)
+
+            for table in self.metadata.sorted_tables:
+                columns = {column['name']: column['type'] for column in existing.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in columns:
+                        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {self.__column_spec(column)}'))
+                        if column.name[:-3] in ENUM_IDS and table is self.vacancies_table:
+                            self.__backfill_enum_ids(connection, table, column.name[:-3])
+                    elif isinstance(column.type, VARCHAR) and not isinstance(columns[column.name], VARCHAR): # Text columns that became indexable
+                        connection.execute(text(f'ALTER TABLE {table.name} MODIFY COLUMN {self.__column_spec(column)}'))
+                    elif isinstance(column.type, JSON) and not isinstance(columns[column.name], JSON): # JSON text that became a JSON column
+                        connection.execute(text(f'ALTER TABLE {table.name} MODIFY COLUMN {self.__column_spec(column)}'))
+
+                indexes = [index['name'] for index in existing.get_indexes(table.name)]
+                for index in table.indexes:
+                    if index.name not in indexes:
+                        index.create(connection)
             connection.commit()
 
-    def __db_get_rows(self, page=0, limit=0, filter={}, table='resumes'):
+    def __unwrap_json(self, connection):
+        # List fields used to be JSON-encoded before the JSON columns encoded them again, leaving a JSON string
+        for field in ('specializations', 'skills', 'languages', 'education'):
+            connection.execute(text(f'UPDATE resumes SET {field} = CAST(JSON_UNQUOTE({field}) AS JSON) WHERE JSON_TYPE({field}) = \'STRING\''))
+
+    def __backfill_resume_set(self, connection, field):
+        table = self.resume_sets[field]
+        rows = connection.execute(select(self.resumes_table.c.id, self.resumes_table.c[field])).all()
+
+        values = [{'resume_id': id, 'value': value} for id, stored in rows for value in DatabaseWorker.set_values(stored)]
+        for i in range(0, len(values), 1000):
+            connection.execute(table.insert().prefix_with('IGNORE'), values[i:i + 1000])
+
+    def __column_spec(self, column):
+        return CreateColumn(column).compile(dialect=self.engine.dialect)
+
+    def __backfill_enum_ids(self, connection, table, field):
+        cases = ' '.join(f'WHEN :name_{i} THEN :id_{i}' for i in range(len(ENUM_IDS[field])))
+        params = {}
+        for i, (name, id) in enumerate(ENUM_IDS[field].items()):
+            params[f'name_{i}'], params[f'id_{i}'] = name, id
+
+        connection.execute(text(f'UPDATE {table.name} SET {field}_id = CASE LOWER({field}) {cases} END'), params)
+
+    def __db_get_rows(self, page=0, limit=0, filter={}, table='resumes', search=None):
         with self.engine.connect() as connection:
-            select_query = self.__build_filtering_query(loads(filter), table) + f' LIMIT {limit} OFFSET {page*limit}'
-            return connection.execute(text(select_query)).mappings().all()
-        
-    def __build_filtering_query(self, filter, table='resumes'):
-        select_query = f'SELECT * FROM {table}'
-        order_by = []
-
-        if filter:
-            select_query += ' WHERE'
-            for key in filter:
-                for entry in filter[key]:
-                    if 'ordering' in entry:
-                        order_by.append([key, entry['ordering']])
-                    select_query += f' {table}.{key} LIKE \'{entry["text"]}\' OR'
-                select_query = select_query[:-2] + 'AND'
-            select_query = select_query[:-3]
-
-        if order_by:
-            select_query += ' ORDER BY'
-            for pair in order_by:
-                select_query += f' {table}.{pair[0]} {pair[1].upper()},'
-            select_query = select_query[:-1]
-
-        return select_query
\ No newline at end of file
+            select_query, params, _ = self.filters[table].prepare(loads(filter), search=search)
+            return DatabaseWorker.as_dicts(connection.execute(select_query, dict(params, limit=limit, offset=page*limit)))
+
+    def __db_get_rows_after(self, cursor='', limit=0, filter={}, table='resumes'):
+        # Keyset pagination: seeks past the last seen (ordering keys..., id) instead of skipping rows with OFFSET
+        after = DatabaseWorker.decode_cursor(cursor) if cursor else None
+
+        with self.engine.connect() as connection:
+            select_query, params, order_by = self.filters[table].prepare(loads(filter), keyset=True, after=after)
+            rows = DatabaseWorker.as_dicts(connection.execute(select_query, dict(params, limit=limit)))
+
+        next_cursor = None
+        if rows and len(rows) == limit:
+            next_cursor = DatabaseWorker.encode_cursor(order_by, [rows[-1][key] for key, _ in order_by])
+        return rows, next_cursor
+
+    def as_dicts(result):
+        keys = list(result.keys())
+        return [dict(zip(keys, row)) for row in result]
+
+    def encode_cursor(order_by, values):
+        return urlsafe_b64encode(dumps([order_by, values], default=str).encode()).decode()
+
+    def decode_cursor(cursor):
+        try:
+            order_by, values = loads(urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise ValueError('Malformed cursor')
+        return order_by, values
@@ -0,0 +1,25 @@
+import csv
+import io
+import json
+
+# Turn chunks of row dicts into encoded NDJSON/CSV pieces for a StreamingResponse, one piece per chunk
+
+def ndjson_chunks(chunks, columns):
+    for rows in chunks:
+        yield ''.join(json.dumps({column: row[column] for column in columns}, ensure_ascii=False) + '\n' for row in rows).encode()
+
+def csv_chunks(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    for rows in chunks:
+        for row in rows: # List fields are written as JSON
+            writer.writerow([json.dumps(row[column], ensure_ascii=False) if isinstance(row[column], list) else row[column] for column in columns])
+
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell(): # Header only, nothing was exported
+        yield buffer.getvalue().encode()
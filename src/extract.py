@@ -0,0 +1,130 @@
+from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+
+class ResumeExtractor:
+    def __init__(self, soup):
+        self.by_qa = {} # data-qa value -> elements in document order
+        self.travel_time = None
+
+        for element in soup.find_all(True): # The only full traversal of the page
+            qa = element.get('data-qa')
+            if qa is not None:
+                self.by_qa.setdefault(qa, []).append(element)
+
+            if self.travel_time is None and element.name == 'span' and 'resume-block-travel-time' in element.get('class', ()):
+                self.travel_time = element
+
+    def first(self, qa):
+        elements = self.by_qa.get(qa)
+        if elements:
+            return elements[0]
+        return None
+
+    def all(self, qa, name=None):
+        return [element for element in self.by_qa.get(qa, ()) if not name or element.name == name]
+
+    def text(self, qa):
+        element = self.first(qa)
+        if element:
+            return fix_spaces(element.text)
+        return None
+
+    def params(self):
+        params = {
+            'gender': self.text('resume-personal-gender'),
+            'age': self.text('resume-personal-age'),
+            'birthday': self.text('resume-personal-birthday'),
+            'search_status': self.text('job-search-status'),
+            'address': self.text('resume-personal-address'),
+            'position': self.text('resume-block-title-position'),
+            'about': self.text('resume-block-skills-content'),
+
+            'specializations': None,
+            'salary': None,
+            'currency': None,
+            'preferred_commute_time': None,
+            'skills': None,
+            'employment': None,
+            'moving_status': None,
+            'citizenship': None,
+            'languages': None,
+            'education': None,
+            'work_experience': None,
+            'work_prev_pos': None,
+            'trips_status': None,
+            'schedule': None,
+        }
+
+        data = self.text('resume-block-position-specialization')
+        if data:
+            params['specializations'] = data.replace(', ', ',').split(',')
+
+        data = self.text('resume-block-salary')
+        if data:
+            params['salary'] = ''.join(data.split(' ')[:-2])
+
+        if self.travel_time:
+            params['preferred_commute_time'] = fix_spaces(self.travel_time.text)
+
+        data = self.first('skills-table')
+        if data:
+            params['skills'] = list(map(lambda x: fix_spaces(x.text), data.find_all(attrs={'data-qa': 'bloko-tag__text'})))
+
+        data = self.first('resume-block-specialization-category')
+        if data:
+            params['employment'], params['schedule'] = list(map(lambda x: ''.join(fix_spaces(x.text).split(':')[1:]).strip().replace(', ', ',').split(','), data.parent.parent.find_all('p')))
+
+        data = self.first('resume-personal-address')
+        if data:
+            params['moving_status'], params['trips_status'] = [x.strip() for x in fix_spaces(data.parent.text).split(',')[-2:]]
+
+        data = self.first('resume-block-additional')
+        if data:
+            params['citizenship'] = list(map(lambda x: ''.join(fix_spaces(x.text).split(':')[1:]).strip(), data.find_all('p')))[0]
+
+        data = self.all('resume-block-language-item', name='p')
+        if data:
+            params['languages'] = list(map(lambda x: fix_spaces(x.text), data))
+
+        data = self.all('resume-block-education-name')
+        if data:
+            params['education'] = list(zip(list(map(lambda x: fix_spaces(x.text), data)), list(map(lambda x: fix_spaces(x.text), self.all('resume-block-education-organization')))))
+
+        data = self.first('resume-block-experience')
+        if data:
+            params['work_experience'] = ' '.join(data.find('h2').text.split()[2:])
+
+        data = self.all('resume-block-experience-position')
+        if data:
+            params['work_prev_pos'] = list(map(lambda x: fix_spaces(x.text), data))
+
+        if params['salary']:
+            currency_cutoff = 0
+            while not params['salary'][:-currency_cutoff].isdigit():
+                currency_cutoff += 1
+
+            params['currency'] = params['salary'][-currency_cutoff:]
+            params['salary'] = int(params['salary'][:-currency_cutoff])
+
+        if params['age']:
+            params['age'] = int(params['age'].split()[0])
+
+        return params
+
+def parse_resume(html, backend='html.parser', encoding=None):
+    return ResumeExtractor(BeautifulSoup(html, backend, from_encoding=encoding)).params()
+
+def parse_resume_links(html, backend='html.parser', encoding=None):
+    soup = BeautifulSoup(html, backend, from_encoding=encoding).find(attrs={'data-qa': 'resume-serp__results-search'}) # Limits parse area
+
+    if soup:
+        soup = [el['href'] for el in soup.find_all('a', attrs={'class': 'bloko-link'})] # Actual links (relative)
+    return soup
+
+def available_backend(backend): # Falls back to the built-in parser if e.g. lxml isn't installed
+    if builder_registry.lookup(backend):
+        return backend
+    return 'html.parser'
+
+def fix_spaces(text): # reformats \xa0 spaces
+    return ' '.join(text.split())
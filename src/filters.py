@@ -0,0 +1,225 @@
+from collections import OrderedDict
+
+from sqlalchemy import Integer, select, and_, or_, false, tuple_, bindparam, func, distinct
+from sqlalchemy.dialects.mysql import match
+
+# Filter JSON: {"column": [entry, ...], ...}, entries of one column are ORed, columns are ANDed.
+# An entry is either the original {"text": "<LIKE pattern>"} or a typed one:
+#   {"op": "eq", "value": x}               {"op": "in", "value": [x, y]}
+#   {"op": "range", "min": a, "max": b}    {"op": "prefix", "value": "abc"}
+#   {"op": "like", "value": "%abc%"}
+# List fields backed by a (resume_id, value) table also take
+#   {"op": "any", "value": [x, y]}         {"op": "all", "value": [x, y]}
+# Any entry may carry "ordering": "asc" | "desc".
+# With a full-text query rows are ranked by relevance first, the orderings break ties.
+
+class FilterEngine:
+    def __init__(self, table, enum_ids={}, search_columns=(), sets={}, columns=None, max_statements=256):
+        self.table = table
+        self.columns = [table.columns[name] for name in columns] if columns else list(table.columns) # Selected ones
+        self.sets = sets # field -> side table of (<row>_id, value)
+        self.enum_ids = enum_ids # field -> {lowercase name: id}, matched against the indexed '<field>_id' column
+        self.search_columns = search_columns # Covered by one FULLTEXT index
+        self.statements = OrderedDict() # filter shape -> select, values are bound at execution, least recently used first
+        self.max_statements = max_statements # Shapes come from clients, the cache must not grow with them
+
+    def prepare(self, filter, keyset=False, after=None, search=None):
+        groups, order_by, params = [], [], {}
+
+        for key in filter:
+            if key not in self.table.columns:
+                raise ValueError(f'Unknown column {key}')
+
+            ops, values = [], {}
+            for i, entry in enumerate(filter[key]):
+                if 'ordering' in entry:
+                    if str(entry['ordering']).lower() not in ('asc', 'desc'):
+                        raise ValueError(f'Unknown ordering {entry["ordering"]}')
+                    order_by.append([key, entry['ordering'].lower()])
+
+                op, bound = self.__parse_entry(self.table.columns[key], entry)
+                ops.append(op)
+                for suffix, value in bound.items():
+                    values[f'p_{key}_{i}{suffix}'] = value
+
+            if 'always' not in ops: # A group with an always-true alternative filters nothing
+                groups.append((key, tuple(ops)))
+                params.update(values)
+
+        if keyset: # Rows are ordered by the keys plus id as a tie-breaker
+            for key, _ in order_by:
+                if self.table.columns[key] not in self.columns:
+                    raise ValueError(f'Can\'t paginate by {key}')
+            order_by.append(['id', order_by[-1][1] if order_by else 'asc'])
+
+            if after:
+                if after[0] != order_by:
+                    raise ValueError('Cursor doesn\'t match the filter\'s ordering')
+                for i, value in enumerate(after[1]):
+                    params[f'after_{i}'] = value
+
+        if search is not None:
+            if keyset or not self.search_columns:
+                raise ValueError('Full-text search isn\'t available here')
+            params['search'] = search
+
+        shape = (tuple(groups), tuple(map(tuple, order_by)), keyset, tuple(value is None for value in after[1]) if after else None, search is not None)
+        statement = self.statements.get(shape)
+        if statement is None:
+            statement = self.statements[shape] = self.__build(shape)
+            if len(self.statements) > self.max_statements:
+                self.statements.popitem(last=False)
+        else:
+            self.statements.move_to_end(shape)
+
+        return statement, params, order_by
+
+    def __build(self, shape):
+        groups, order_by, keyset, after_nulls, search = shape
+        statement = select(*self.columns)
+
+        conditions = []
+        if search:
+            relevance = match(*[self.table.columns[key] for key in self.search_columns], against=bindparam('search')).in_natural_language_mode()
+            statement = statement.order_by(relevance.desc())
+            conditions.append(relevance)
+
+        for key, ops in groups:
+            alternatives = [self.__condition(key, op, f'p_{key}_{i}') for i, op in enumerate(ops) if op != 'never']
+            conditions.append(or_(*alternatives) if alternatives else false())
+        if after_nulls is not None:
+            conditions.append(self.__seek_condition(order_by, after_nulls))
+        if conditions:
+            statement = statement.where(and_(*conditions))
+
+        for key, direction in order_by:
+            column = self.table.columns[key]
+            statement = statement.order_by(column.desc() if direction == 'desc' else column.asc())
+
+        statement = statement.limit(bindparam('limit'))
+        if not keyset:
+            statement = statement.offset(bindparam('offset'))
+        return statement
+
+    def __condition(self, key, op, name):
+        column = self.table.columns[key]
+
+        if op == 'notnull':
+            return column.is_not(None)
+        if op == 'eq':
+            return column == bindparam(name)
+        if op == 'eq_id':
+            return self.table.columns[f'{key}_id'] == bindparam(name)
+        if op == 'in':
+            return column.in_(bindparam(name, expanding=True))
+        if op == 'in_id':
+            return self.table.columns[f'{key}_id'].in_(bindparam(name, expanding=True))
+        if op == 'min':
+            return column >= bindparam(name + '_min')
+        if op == 'max':
+            return column <= bindparam(name + '_max')
+        if op == 'range':
+            return and_(column >= bindparam(name + '_min'), column <= bindparam(name + '_max'))
+        if op == 'any':
+            return self.table.c.id.in_(self.__set_members(key, name))
+        if op == 'all':
+            members = self.__set_members(key, name).group_by(self.sets[key].c.resume_id)
+            return self.table.c.id.in_(members.having(func.count(distinct(self.sets[key].c.value)) == bindparam(name + '_count')))
+        return column.like(bindparam(name)) # like, prefix
+
+    def __set_members(self, key, name): # Served by the side table's (value, resume_id) index
+        side = self.sets[key]
+        return select(side.c.resume_id).where(side.c.value.in_(bindparam(name, expanding=True)))
+
+    def __parse_entry(self, column, entry):
+        op = entry.get('op')
+
+        if op in ('any', 'all'):
+            if column.name not in self.sets:
+                raise ValueError(f'Set filter on non-list column {column.name}')
+
+            values = {}
+            for value in entry['value']: # Deduplicated the same way as the stored values
+                values.setdefault(str(value).strip().casefold(), str(value).strip())
+            if not values:
+                return ('always' if op == 'all' else 'never'), {}
+            if op == 'any':
+                return 'any', {'': list(values.values())}
+            return 'all', {'': list(values.values()), '_count': len(values)}
+
+        if op is None and 'text' not in entry:
+            return 'always', {} # Ordering only
+
+        if op is None: # Original format, a LIKE pattern
+            pattern = str(entry['text'])
+            if not pattern.strip('%'):
+                return ('notnull' if column.nullable else 'always'), {}
+            if '%' in pattern or '_' in pattern:
+                return 'like', {'': pattern}
+            op, value = 'eq', pattern
+
+            if isinstance(column.type, Integer) and not pattern.lstrip('-').isdigit():
+                return 'never', {} # Can never match a number
+        elif op in ('eq', 'like', 'prefix'):
+            value = entry['value']
+        elif op == 'in':
+            value = list(entry['value'])
+            if not value:
+                return 'never', {}
+        elif op == 'range':
+            if not isinstance(column.type, Integer):
+                raise ValueError(f'Range filter on non-numeric column {column.name}')
+            bounds = {suffix: int(entry[name]) for suffix, name in (('_min', 'min'), ('_max', 'max')) if entry.get(name) is not None}
+            if not bounds:
+                return ('notnull' if column.nullable else 'always'), {}
+            return {'_min': 'min', '_max': 'max'}.get(''.join(bounds), 'range'), bounds
+        else:
+            raise ValueError(f'Unknown filter operator {op}')
+
+        if op == 'prefix':
+            value = str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            return 'prefix', {'': value}
+        if op == 'like':
+            return 'like', {'': str(value)}
+
+        values = value if op == 'in' else [value]
+        if isinstance(column.type, Integer):
+            try:
+                values = [int(value) for value in values]
+            except (TypeError, ValueError):
+                raise ValueError(f'Non-numeric value for {column.name}')
+
+        ids = self.enum_ids.get(column.name)
+        if ids: # Known names (or ids themselves) compare against the indexed id column
+            mapped = [ids.get(str(value).lower(), value if value in ids.values() else None) for value in values]
+            if None not in mapped:
+                op, values = op + '_id', mapped
+
+        return op, {'': values if op.startswith('in') else values[0]}
+
+    def __seek_condition(self, order_by, nulls):
+        columns = [self.table.columns[key] for key, _ in order_by]
+
+        # (key, id) > (...) is served by a range scan on the index, but only works without NULLs in ascending order
+        if all(direction == 'asc' for _, direction in order_by) and not any(nulls):
+            return tuple_(*columns) > tuple_(*[bindparam(f'after_{i}') for i in range(len(columns))])
+
+        # Otherwise expanded per key, MySQL sorts NULLs first in ASC and last in DESC
+        alternatives = []
+        for i, (column, (_, direction)) in enumerate(zip(columns, order_by)):
+            terms = [previous.is_(None) if nulls[j] else previous == bindparam(f'after_{j}') for j, previous in enumerate(columns[:i])]
+
+            if nulls[i]:
+                if direction == 'desc':
+                    continue
+                terms.append(column.is_not(None))
+            elif direction == 'asc':
+                terms.append(column > bindparam(f'after_{i}'))
+            elif column.nullable:
+                terms.append(or_(column < bindparam(f'after_{i}'), column.is_(None)))
+            else:
+                terms.append(column < bindparam(f'after_{i}'))
+
+            alternatives.append(and_(*terms))
+
+        return or_(*alternatives) if alternatives else false()
@@ -0,0 +1,203 @@
+import asyncio
+import random
+import httpx
+from time import monotonic
+from urllib.parse import urlsplit
+
+from src.metrics import metrics
+from src.tracing import span
+
+# Every upstream request goes through here. Each host has its own token bucket (steady request rate plus a small burst)
+# and a concurrency limit adapted like TCP's window: it grows by one per window of fast successes and is halved
+# on throttling (429), server errors or slow responses. Retries back off exponentially with full jitter.
+
+class UpstreamError(Exception):
+    def __init__(self, host, status=None, detail=''):
+        self.host = host
+        self.status = status # Upstream HTTP status, None if no response came back
+        self.retry_after = None
+        super().__init__(f'{host} responded with {status}' if status else f'{host} is unreachable: {detail}')
+
+    def throttled(self):
+        return self.status == 429
+
+    def unavailable(self):
+        return self.status is None or self.status >= 500
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    async def acquire(self):
+        while True:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class HostLimiter:
+    def __init__(self, config):
+        self.bucket = TokenBucket(config['rate'], config['burst'])
+        self.min_concurrency = config['min_concurrency']
+        self.max_concurrency = config['max_concurrency']
+        self.latency_target = config['latency_target']
+
+        self.limit = float(config['min_concurrency']) # Starts low and probes upwards
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.decreased_at = 0.0
+
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            await self.bucket.acquire()
+        except BaseException: # Cancelled while waiting for a token, e.g. a hedge that lost, the slot is given back
+            await self.__aexit__()
+            raise
+
+    async def __aexit__(self, *args):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def success(self, latency):
+        if latency > self.latency_target:
+            self.decrease()
+        else: # Additive increase, about +1 per limit's worth of requests
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def decrease(self):
+        now = monotonic()
+        if now - self.decreased_at < self.latency_target: # One cut per round trip, responses of the same burst don't compound
+            return
+        self.decreased_at = now
+        self.limit = max(self.min_concurrency, self.limit / 2)
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'tokens': round(self.bucket.tokens, 2),
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'errors': self.errors,
+        }
+
+class Governor:
+    def __init__(self, config):
+        self.hosts = config['upstream_hosts'] # host -> limits, '*' is used for hosts that aren't listed
+        self.retries = config['upstream_retries']
+        self.backoff_base = config['upstream_backoff_base']
+        self.backoff_max = config['upstream_backoff_max']
+        self.limiters = {}
+
+    async def get(self, client, url, kind='page', **kwargs): # kind labels the request's metrics
+        host = urlsplit(url).hostname
+        limiter = self.limiter(host)
+
+        with span('upstream', host=host, kind=kind) as traced:
+            waited = 0.0 # In the host's limiter, the rest of the span is the responses and the backoffs
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    limiter.retries += 1
+                    await asyncio.sleep(self.backoff(attempt, error.retry_after))
+
+                limiter.requests += 1
+                queued = monotonic()
+                async with limiter:
+                    started = monotonic()
+                    waited += started - queued
+                    traced.set(attempts=attempt + 1, limiter_ms=round(waited * 1000, 2))
+                    try:
+                        r = await client.get(url, **kwargs)
+                    except httpx.HTTPError as exc:
+                        limiter.errors += 1
+                        limiter.decrease()
+                        metrics.inc('upstream_requests_total', host=host, kind=kind, status='error')
+                        error = UpstreamError(host, detail=repr(exc))
+                        traced.set(status='error')
+                        continue
+                    latency = monotonic() - started
+
+                metrics.observe('upstream_request_duration_seconds', latency, host=host, kind=kind)
+                metrics.inc('upstream_requests_total', host=host, kind=kind, status=r.status_code)
+                traced.set(status=r.status_code)
+
+                if r.status_code < 400:
+                    limiter.success(latency)
+                    return r
+
+                error = UpstreamError(host, r.status_code)
+                if r.status_code == 429:
+                    limiter.throttled += 1
+                    error.retry_after = Governor.retry_after(r)
+                elif r.status_code >= 500:
+                    limiter.errors += 1
+                else: # The request itself is rejected, repeating it won't help
+                    limiter.success(latency)
+                    raise error
+                limiter.decrease()
+
+            raise error
+
+    async def hedged(self, client, url, delay, kind='page', **kwargs):
+        # Once the request runs past delay a second one goes out, whichever succeeds first is used and the other cancelled
+        host = urlsplit(url).hostname
+        first = asyncio.ensure_future(self.get(client, url, kind, **kwargs))
+        pending, hedge = {first}, None
+
+        try:
+            if delay is not None:
+                await asyncio.wait(pending, timeout=delay)
+                limiter = self.limiter(host)
+                if not first.done() and limiter.in_flight < int(limiter.limit): # Hedges never queue behind the host's limit
+                    hedge = asyncio.ensure_future(self.get(client, url, kind, **kwargs))
+                    pending.add(hedge)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.exception():
+                        if hedge:
+                            metrics.inc('upstream_hedges_total', host=host, kind=kind, winner='hedge' if task is hedge else 'first')
+                        return task.result()
+            return first.result() # Both failed, raises the first one's error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def limiter(self, host):
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = HostLimiter(self.hosts.get(host, self.hosts['*']))
+        return limiter
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if retry_after:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def stats(self):
+        return {host: limiter.stats() for host, limiter in self.limiters.items()}
+
+    def retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
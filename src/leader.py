@@ -0,0 +1,48 @@
+import fcntl
+import os
+
+# Coordinates the processes of one deployment (e.g. 'uvicorn --workers N') through two lock files.
+# The leader holds 'leader.lock' for as long as it lives, it alone sets up the schema and runs the writers and
+# the crawler. 'setup.lock' is held while a new leader sets up, so a process that finds the leadership taken
+# also knows the schema is ready. Both are POSIX record locks (lockf): they belong to the process that took them,
+# forked writers and pool workers don't inherit them, so the kernel releases them when the leader itself dies
+# and another process takes over. flock locks would live on in the children's copies of the descriptor.
+
+class Leadership:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'leader.lock')
+        self.setup_path = os.path.join(directory, 'setup.lock')
+        self.file = None
+
+    def acquire(self, setup): # Blocks only while another process sets up, True if this one leads now
+        if self.file:
+            return True
+
+        with open(self.setup_path, 'a') as setup_lock:
+            fcntl.lockf(setup_lock, fcntl.LOCK_EX)
+
+            file = open(self.path, 'a')
+            try:
+                fcntl.lockf(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError: # EACCES or EAGAIN, held by another process
+                file.close()
+                return False
+
+            try:
+                setup()
+            except:
+                file.close() # Someone else may succeed
+                raise
+
+            self.file = file
+            return True
+
+    def release(self):
+        if self.file:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def leader(self):
+        return self.file is not None
@@ -1,132 +1,440 @@
 import json
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response, Header
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from typing import Optional, Literal
+from itertools import chain
 
 from contextlib import asynccontextmanager
-from multiprocessing import Process, Queue, Event, Lock
-
-from src.parse import ParserInstance
+from multiprocessing import Process, Queue, Event, Lock, Value
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty
+from time import monotonic, time, perf_counter
+from sqlalchemy.exc import DBAPIError, OperationalError, InterfaceError
+import asyncio
+import os
+
+from src.parse import ParserInstance, ResumeProgress
 from src.db import DatabaseWorker
+from src.cache import ResultCache
+from src.crawler import Crawler
+from src.governor import UpstreamError
+from src.export import ndjson_chunks, csv_chunks
+from src.spill import SpillLog
+from src.leader import Leadership
+from src.metrics import metrics, MetricsMiddleware
+from src.tracing import tracer, span, trace_id, TracingMiddleware
 from src.structs import Vacancy, Resume
 
-db, parser = None, None
+db, parser, cache, crawler = None, None, None, None
+
+export_chunk_size = None
+max_search_limit = None
+
+parse_pool = None
+
+leadership = None
+
+# Created when this process becomes the leader, never at import, so every worker of a deployment can import the module
+processes_stop, stdout_lock, procs = None, None, {}
 
-processes_stop = Event()
+db_queues, queued_rows = {}, {} # Writer queues and the rows in each, capped by queue_max_rows
+spills, queue_max_rows = {}, None
 
-stdout_lock = Lock() 
+KINDS = ('resumes', 'vacancies')
 
-resumes_db_queue, vacancies_db_queue = Queue(), Queue()
+resume_progress = {} # Cache key -> ResumeProgress of the running fetch, read by requests whose deadline passes
+
+# mysql-connector's client errors for a connection that's refused, dropped or gone. A refused connection (2003)
+# comes as a plain DatabaseError, so the class alone doesn't tell an outage from a bad row.
+OUTAGE_ERRNOS = {2002, 2003, 2005, 2006, 2013, 2055}
+
+class DatabaseOutage(Exception): # The database can't be reached, rows are kept in the spill log until it's back
+    pass
+
+def is_outage(exc):
+    if not isinstance(exc, DBAPIError):
+        return False
+    return (exc.connection_invalidated or isinstance(exc, (OperationalError, InterfaceError))
+            or getattr(exc.orig, 'errno', None) in OUTAGE_ERRNOS)
 
 def load_config(file_path):
     with open(file_path) as f:
         config = json.loads(f.read())
     return config
 
-def push_resumes(stop_event, stdout_lock, queue):
-    db = DatabaseWorker(load_config('./db_config.json'))
-
-    while not stop_event.is_set():
-        params = queue.get()
-        if not params: # Stop if None
+def resume_row(params):
+    return dict(id=params['id'],
+                gender=params['gender'],
+                birthday=params['birthday'],
+                address=params['address'],
+                position=params['position'],
+                search_status=params['search_status'],
+                about=params['about'],
+                preferred_commute_time=params['preferred_commute_time'],
+                moving_status=params['moving_status'],
+                citizenship=params['citizenship'],
+                salary=params['salary'],
+                currency=params['currency'],
+                age=params['age'], 
+
+                specializations=params['specializations'], 
+                skills=params['skills'], 
+                employment=params['employment'],
+                languages=params['languages'], 
+                education=params['education'], 
+                schedule=params['schedule'])
+
+def vacancy_row(params):
+    return dict(id=params['id'], 
+                name=params['name'], 
+                area=params['area'],
+                average_salary=params['average_salary'], 
+                currency=params['currency'],
+                type=params['type'], 
+                employer=params['employer'], 
+                requirement=params['requirement'],
+                responsibility=params['responsibility'],
+                schedule=params['schedule'], 
+                experience=params['experience'],
+                employment=params['employment'])
+
+def spill_log(config, kind):
+    return SpillLog(os.path.join(config['spill_dir'], kind), config['spill_segment_bytes'], config['spill_segment_age'])
+
+def collect_batch(queue, size, max_latency, idle_timeout): # Entries until they hold size rows, an entry is a whole fetch
+    try:
+        batch = [queue.get(timeout=idle_timeout)] # Waits for the first entry, returns empty to let the spill log replay
+    except Empty:
+        return []
+    deadline = monotonic() + max_latency
+    rows = len(batch[0] or ())
+
+    while batch[-1] is not None and rows < size:
+        timeout = deadline - monotonic()
+        if timeout <= 0:
             break
         try:
-            db.add_resume(id=params['id'],
-                          gender=params['gender'],
-                          birthday=params['birthday'],
-                          address=params['address'],
-                          position=params['position'],
-                          search_status=params['search_status'],
-                          about=params['about'],
-                          preferred_commute_time=params['preferred_commute_time'],
-                          moving_status=params['moving_status'],
-                          citizenship=params['citizenship'],
-                          salary=params['salary'],
-                          currency=params['currency'],
-                          age=params['age'], 
-
-                          specializations=to_json(params['specializations']), 
-                          skills=to_json(params['skills']), 
-                          employment=to_json(params['employment']),
-                          languages=to_json(params['languages']), 
-                          education=to_json(params['education']), 
-                          schedule=to_json(params['schedule']))
+            batch.append(queue.get(timeout=timeout))
+        except Empty:
+            break
+        rows += len(batch[-1] or ())
+
+    return batch
+
+def write_batch(stdout_lock, write, rows):
+    try:
+        write(rows)
+    except Exception as exc:
+        if is_outage(exc): # Not the rows' fault, the caller keeps them
+            raise DatabaseOutage(exc) from exc
+        if len(rows) == 1:
+            with stdout_lock:
+                print('Error adding entry: ', exc, '\nSkipping')
+            return
+
+        # Splits the batch to isolate bad rows, the rest is still written
+        write_batch(stdout_lock, write, rows[:len(rows)//2])
+        write_batch(stdout_lock, write, rows[len(rows)//2:])
+
+def to_rows(stdout_lock, to_row, entry):
+    rows = []
+    for params in entry: # Entries are the lists queued by one fetch
+        try:
+            rows.append(to_row(params))
         except Exception as exc:
             with stdout_lock:
                 print('Error adding entry: ', exc, '\nSkipping')
+    return rows
+
+def traced_entries(entries): # Trace id -> time queued, of the traced requests that queued these entries
+    return {entry[0]['_trace']: entry[0]['_queued_at'] for entry in entries if entry and '_trace' in entry[0]}
+
+def record_writes(traces, rows, started, outcome):
+    duration = perf_counter() - started
+    for id, queued_at in traces.items():
+        tracer.record({'trace': id, 'name': 'write', 'pid': os.getpid(), 'rows': rows, 'outcome': outcome,
+                       'queued_ms': round((time() - duration - queued_at) * 1000, 2), 'duration_ms': round(duration * 1000, 2)})
+
+def write_rows(stdout_lock, write, rows, size):
+    for i in range(0, len(rows), size):
+        write_batch(stdout_lock, write, rows[i:i + size])
+
+def replay_segment(stdout_lock, spill, write, to_row, config): # Replays the oldest spilled segment, False if there's none
+    segments = spill.segments()
+    if not segments:
+        return False
+
+    entries, corrupted = spill.read(segments[0])
+    if corrupted:
+        with stdout_lock:
+            print(f'Error replaying {segments[0]}: ', corrupted, ' corrupted entries\nSkipping')
+
+    rows = [row for entry in entries for row in to_rows(stdout_lock, to_row, entry)]
+    started = perf_counter()
+    write_rows(stdout_lock, write, rows, config['batch_size']) # Raises during an outage, the segment stays
+    spill.remove(segments[0])
+
+    traces = traced_entries(entries)
+    if traces:
+        record_writes(traces, len(rows), started, 'replayed')
+    return True
 
-def push_vacancies(stop_event, stdout_lock, queue):
-    db = DatabaseWorker(load_config('./db_config.json'))
+def push_rows(stop_event, stdout_lock, queue, queued, write, to_row, config, spill):
+    spill.recover()
+    replayed_at = 0.0
 
     while not stop_event.is_set():
-        params = queue.get()
-        if params == None:
+        batch = collect_batch(queue, config['batch_size'], config['batch_max_latency'], config['replay_interval'])
+        stop = None in batch # Stop if None
+        traces = traced_entries(batch)
+
+        rows = []
+        for entry in batch:
+            if entry is None:
+                break
+            with queued.get_lock():
+                queued.value -= len(entry)
+            rows.extend(to_rows(stdout_lock, to_row, entry))
+
+        started, written = perf_counter(), True
+        try:
+            if rows: # In statements of batch_size rows, a single fetch can be larger
+                write_rows(stdout_lock, write, rows, config['batch_size'])
+                if traces:
+                    record_writes(traces, len(rows), started, 'written')
+        except DatabaseOutage as exc:
+            # The whole batch is spilled as queued, so trace ids survive. Chunks that were already committed are
+            # written again on replay, which the upsert makes harmless.
+            for entry in batch:
+                if entry:
+                    spill.append(entry)
+            spill.seal()
+            if traces:
+                record_writes(traces, len(rows), started, 'spilled')
+            outage(stdout_lock, exc, spill, stop_event, config)
+            written = False
+
+        try: # Spilled rows go in between live batches, a segment at a time, once the database is back
+            if written and monotonic() - replayed_at >= config['replay_interval']:
+                while replay_segment(stdout_lock, spill, write, to_row, config) and not batch:
+                    pass
+                replayed_at = monotonic()
+        except DatabaseOutage as exc: # The segment stays for the next replay
+            outage(stdout_lock, exc, spill, stop_event, config)
+
+        if stop:
+            break
+
+    remaining = [] # Whatever is still queued is written, or kept for the next start
+    while True:
+        try:
+            entry = queue.get_nowait()
+        except Empty:
             break
+        if entry:
+            remaining.append(entry)
 
+    try:
+        write_rows(stdout_lock, write, [row for entry in remaining for row in to_rows(stdout_lock, to_row, entry)], config['batch_size'])
+    except DatabaseOutage:
+        for entry in remaining:
+            spill.append(entry)
+    spill.seal()
+
+def outage(stdout_lock, exc, spill, stop_event, config):
+    with stdout_lock:
+        print('Error writing to the database: ', exc, '\nRows are kept in ', spill.directory)
+    stop_event.wait(config['outage_backoff'])
+
+def measured(write, kind):
+    def write_measured(rows):
         try:
-            db.add_vacancy(id=params['id'], 
-                           name=params['name'], 
-                           area=params['area'],
-                           average_salary=params['average_salary'], 
-                           currency=params['currency'],
-                           type=params['type'], 
-                           employer=params['employer'], 
-                           requirement=params['requirement'],
-                           responsibility=params['responsibility'],
-                           schedule=params['schedule'], 
-                           experience=params['experience'],
-                           employment=params['employment'])
+            with metrics.timer('db_upsert_duration_seconds', kind=kind):
+                write(rows)
         except Exception as exc:
-            with stdout_lock:
-                print('Error adding entry: ', exc, '\nSkipping')
+            metrics.inc('db_write_errors_total', kind=kind, error=type(exc).__name__)
+            raise
+        finally:
+            metrics.save()
+        metrics.observe('db_batch_rows', len(rows), kind=kind)
+    return write_measured
+
+def push_resumes(stop_event, stdout_lock, queue, queued):
+    config = load_config('./db_config.json')
+    db = DatabaseWorker(config)
+    metrics.reset()
+    metrics.configure(config['metrics_dir'], config['metrics_interval'])
+    tracer.configure(config['trace_token'], config['trace_sample_rate'], config['trace_log'], config['trace_log_bytes'])
+    push_rows(stop_event, stdout_lock, queue, queued, measured(db.add_resumes, 'resumes'), resume_row, config, spill_log(config, 'resumes'))
+    metrics.save(force=True)
+
+def push_vacancies(stop_event, stdout_lock, queue, queued):
+    config = load_config('./db_config.json')
+    db = DatabaseWorker(config)
+    metrics.reset()
+    metrics.configure(config['metrics_dir'], config['metrics_interval'])
+    tracer.configure(config['trace_token'], config['trace_sample_rate'], config['trace_log'], config['trace_log_bytes'])
+    push_rows(stop_event, stdout_lock, queue, queued, measured(db.add_vacancies, 'vacancies'), vacancy_row, config, spill_log(config, 'vacancies'))
+    metrics.save(force=True)
+
+def writers_start():
+    global processes_stop, stdout_lock
+    processes_stop, stdout_lock = Event(), Lock()
+
+    for kind, push in (('resumes', push_resumes), ('vacancies', push_vacancies)):
+        queue, queued = Queue(), Value('q', 0)
+        procs[kind] = Process(target=push, args=(processes_stop, stdout_lock, queue, queued))
+        procs[kind].start()
+        db_queues[kind], queued_rows[kind] = queue, queued
+
+def writers_stop():
+    queues = dict(db_queues)
+    db_queues.clear() # Rows fetched from now on are spilled
 
-procs = {
-    "resumes": Process(target=push_resumes, args=(processes_stop, stdout_lock, resumes_db_queue)),
-    "vacancies": Process(target=push_vacancies, args=(processes_stop, stdout_lock, vacancies_db_queue))
-}
+    processes_stop.set()    # Redundant stopper (to avoid while True in the code)
+    for queue in queues.values():
+        queue.put(None)     # Send exit signal
+    for proc in procs.values():
+        proc.join()
+    procs.clear()
+
+    for kind in KINDS: # Dumped before the leadership is released, a new leader may only fold this dump much later
+        metrics.set('db_queue_rows', 0, kind=kind)
+    metrics.save(force=True)
+
+def lead(): # Takes the leadership if it's free, the schema is set up before the writers start
+    if not leadership.acquire(db.setup):
+        return False
+    take_over()
+    return True
+
+def take_over(): # On the main thread, forking from a pool thread would copy locks other threads hold
+    metrics.cleanup() # Counters of a previous run's processes
+    writers_start()
+
+async def contend(interval): # Followers take over when the leader is gone
+    while not leadership.leader():
+        await asyncio.sleep(interval)
+        try:
+            if await run_in_threadpool(leadership.acquire, db.setup): # Blocks while another process sets up
+                take_over()
+                print(f'Process {os.getpid()} took over the writers')
+                if crawler:
+                    crawler.start(await load_crawl_runs())
+        except Exception as exc:
+            print('Error taking over the writers: ', exc)
+
+def queue_rows(kind, rows):
+    with span('queue', kind=kind, rows=len(rows)) as traced:
+        id = trace_id()
+        if id: # The entry's first row carries the request's trace id to the writer, the row mapping drops it
+            rows[0] = dict(rows[0], _trace=id, _queued_at=time())
+
+        queue = db_queues.get(kind)
+        if queue is None: # A follower, the spill log carries the rows to the leader's writers
+            spills[kind].append(rows)
+            traced.set(spilled=True)
+            return
+
+        with queued_rows[kind].get_lock():
+            room = queued_rows[kind].value + len(rows) <= queue_max_rows
+            if room:
+                queued_rows[kind].value += len(rows)
+
+        if room: # One entry for the whole fetch, a single pickle and pipe write
+            queue.put_nowait(rows)
+        else: # The writer is behind, memory stays bounded and the rows wait on disk
+            spills[kind].append(rows)
+        traced.set(spilled=not room)
 
 def queue_resumes(*args):
-    global resumes_db_queue
-    for arg in args:
-        resumes_db_queue.put_nowait(arg)
+    if args:
+        queue_rows('resumes', list(args))
 
 def queue_vacancies(*args):
-    global vacancies_db_queue
-    for arg in args:
-        vacancies_db_queue.put_nowait(arg)
+    if args:
+        queue_rows('vacancies', list(args))
+
+def queue_stats():
+    stats = {kind: dict(queued_rows=queued_rows[kind].value if kind in db_queues else 0, **spills[kind].stats()) for kind in spills}
+    stats['leader'] = leadership.leader()
+    return stats
+
+async def seal_spills(interval): # Spilled rows become replayable even when no more are spilled
+    while True:
+        await asyncio.sleep(interval)
+        for spill in spills.values():
+            spill.seal_stale()
+        measure_queues()
+        metrics.save()
+        if leadership.leader(): # Dumps of processes that exited since, e.g. the previous leader's
+            metrics.cleanup()
+
+def measure_queues():
+    for kind in db_queues:
+        metrics.set('db_queue_rows', queued_rows[kind].value, kind=kind)
 
-def procs_start():
-    global procs
-    procs['resumes'].start()
-    procs['vacancies'].start()
+def procs_start(parse_workers):
+    global parse_pool
+
+    lead() # Or follow, once the leader has set up the schema
+
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+    parse_pool.submit(int).result() # Forks the workers now, before requests are served
 
 def shutdown():
-    global procs, processes_stop
+    if leadership.leader():
+        writers_stop()
+        leadership.release() # Only after the writers are gone, a follower's writers never overlap with them
 
-    processes_stop.set()    # Redundant stopper (to avoid while True in the code)
-    queue_resumes(None)     # Send exit signal
-    queue_vacancies(None)   # Send exit signal
+    parse_pool.shutdown(cancel_futures=True)
 
-    procs['resumes'].join()
-    procs['vacancies'].join()
+    for spill in spills.values():
+        spill.seal()
+    metrics.save(force=True)
 
 def init():
-    global parser, db
+    global parser, db, cache, crawler, leadership, export_chunk_size, max_search_limit, queue_max_rows
 
     try:
-        db = DatabaseWorker(load_config('db_config.json'))
-        parser = ParserInstance(load_config('parse_config.json'))
+        db_config = load_config('db_config.json')
+        db = DatabaseWorker(db_config)
+        leadership = Leadership(db_config['lock_dir'])
+        metrics.configure(db_config['metrics_dir'], db_config['metrics_interval'])
+        tracer.configure(db_config['trace_token'], db_config['trace_sample_rate'], db_config['trace_log'], db_config['trace_log_bytes'])
+        export_chunk_size = db_config['export_chunk_size']
+        queue_max_rows = db_config['queue_max_rows']
+        spills.update({kind: spill_log(db_config, kind) for kind in KINDS})
+        parse_config = load_config('parse_config.json')
+        parser = ParserInstance(parse_config)
+        max_search_limit = parse_config['max_search_limit']
+        cache = ResultCache(parse_config['cache_max_size'], {'vacancies': parse_config['vacancies_cache_ttl'],
+                                                             'resumes': parse_config['resumes_cache_ttl']})
+        if parse_config['crawl_enabled']:
+            crawler = Crawler(parse_config, crawl, sync_vacancies, record_crawl_run)
     except Exception as e:
         print(f'Error:\n-> {e}\nwhile loading config/s and/or modules.')
         exit(-1)
 
-    procs_start()
+    procs_start(parse_config['parse_workers'])
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init() # Loads configuration files and starts processes
+    await parser.open(parse_pool) # Opens pooled upstream connections
+    if crawler and leadership.leader():
+        crawler.start(await load_crawl_runs()) # Schedules the warm-up queries
+    config = load_config('db_config.json')
+    tasks = [asyncio.create_task(seal_spills(config['spill_segment_age'])), asyncio.create_task(contend(config['leader_retry_interval']))]
     yield
+    for task in tasks:
+        task.cancel()
+    if crawler:
+        crawler.stop()
+    await parser.close()
     shutdown() # Stops running processes
 
 app = FastAPI(lifespan=lifespan)
@@ -134,43 +442,222 @@ app.add_middleware(CORSMiddleware,
                    allow_origins=['*'],
                    allow_credentials=True,
                    allow_methods=['*'],
-                   allow_headers=['*'])
+                   allow_headers=['*'],
+                   expose_headers=['X-Next-Cursor', 'X-Trace-Id', 'Server-Timing', 'X-Complete', 'X-Completeness'])
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+app.add_middleware(TracingMiddleware, tracer=tracer)
+
+async def fetch_vacancies(**params):
+    vacancies = await parser.get_vacancies(**params)
+    if vacancies:
+        queue_vacancies(*vacancies)
+    return vacancies
+
+async def fetch_resumes(**params):
+    stored = {}
+
+    async def lookup(ids):
+        try:
+            stored.update(await run_in_threadpool(db.get_fresh_resumes, ids, parser.resume_fresh_age))
+        except Exception as exc: # Scrape everything if the database can't answer
+            print('Error looking up stored resumes: ', exc)
+        return stored
+
+    key = ResultCache.make_key('resumes', params)
+    progress = resume_progress[key] = ResumeProgress()
+    try:
+        resumes = await parser.get_resumes(lookup=lookup, progress=progress, **params)
+    finally:
+        if resume_progress.get(key) is progress:
+            del resume_progress[key]
+    if resumes:
+        queue_resumes(*[resume for resume in resumes if resume['id'] not in stored]) # Stored ones are fresh already
+    return resumes
+
+async def crawl(kind, **params):
+    # Same parameters as the search endpoints so the crawled pages land on their cache keys
+    params = dict(dict(page=0, text=None, experience=None, schedule=None, employment=None, salary=None, pages=1, limit=None), **params)
+    fetch = fetch_vacancies if kind == 'vacancies' else fetch_resumes
+    return await cache.refresh(kind, fetch, **params)
+
+async def sync_vacancies(query, **params):
+    since = await run_in_threadpool(db.get_watermark, query)
+    vacancies, watermark = await parser.get_new_vacancies(since, **params)
+    await run_in_threadpool(db.sync_vacancies, query, [vacancy_row(vacancy) for vacancy in vacancies], watermark)
+    return vacancies
+
+async def record_crawl_run(run):
+    await run_in_threadpool(db.record_crawl_run, run)
+
+async def load_crawl_runs():
+    try:
+        return await run_in_threadpool(db.get_crawl_runs)
+    except Exception as exc: # Starts a fresh schedule
+        print('Error loading crawl runs: ', exc)
+        return {}
+
+def upstream_exception(exc):
+    if exc.throttled(): # Throttled even after backing off
+        return HTTPException(status_code=503, detail=str(exc), headers={'Retry-After': str(int(exc.retry_after or 1))})
+    if exc.unavailable():
+        return HTTPException(status_code=502, detail=str(exc))
+    return HTTPException(status_code=500, detail=str(exc)) # The query itself was rejected
+
+def check_window(pages, limit):
+    if pages < 1 or limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail='pages and limit must be positive')
+    if (limit or pages * ParserInstance.page_size) > max_search_limit:
+        raise HTTPException(status_code=400, detail=f'At most {max_search_limit} results per request')
 
 @app.get('/search/vacancies')
-def search_vacancies(page: int=0, text: str=None, experience: str=None, schedule: str=None, employment: str=None, salary: int=None) -> list[Optional[Vacancy]]:
-    vacancies = parser.get_vacancies(page=page, text=text, experience=experience, schedule=schedule, employment=employment, salary=salary)
+async def search_vacancies(page: int=0, text: str=None, experience: str=None, schedule: str=None, employment: str=None, salary: int=None, pages: int=1, limit: int=None) -> list[Optional[Vacancy]]:
+    check_window(pages, limit)
+    try:
+        vacancies = await cache.get('vacancies', fetch_vacancies, page=page, text=text, experience=experience, schedule=schedule, employment=employment, salary=salary, pages=pages, limit=limit)
+    except UpstreamError as exc:
+        raise upstream_exception(exc)
     if not vacancies:
         raise HTTPException(status_code=500, detail='Failed to parse by requested vacancies\' params')
 
-    queue_vacancies(*vacancies)
     return vacancies
 
 @app.get('/search/resumes')
-def search_resumes(page: int=0, text: str=None, experience: str=None, schedule: str=None, salary: int=None, employment: str=None) -> list[Optional[Resume]]:
-    resumes = parser.get_resumes(page=page, text=text, experience=experience, schedule=schedule, employment=employment, salary=salary)
+async def search_resumes(response: Response, page: int=0, text: str=None, experience: str=None, schedule: str=None, salary: int=None, employment: str=None, pages: int=1, limit: int=None, deadline: float=None) -> list[Optional[Resume]]:
+    check_window(pages, limit)
+    if deadline is not None and deadline <= 0:
+        raise HTTPException(status_code=400, detail='deadline must be positive')
+
+    params = dict(page=page, text=text, experience=experience, schedule=schedule, employment=employment, salary=salary, pages=pages, limit=limit)
+    try: # Past the deadline the shared fetch goes on, its resumes are still queued and cached once it's done
+        resumes = await asyncio.wait_for(cache.get('resumes', fetch_resumes, **params), deadline)
+    except asyncio.TimeoutError: # Whatever is parsed so far
+        progress = resume_progress.get(ResultCache.make_key('resumes', params))
+        response.headers['X-Complete'] = 'false'
+        response.headers['X-Completeness'] = f'{progress.completeness() if progress else 0.0:.2f}'
+        return progress.results() if progress else []
+    except UpstreamError as exc:
+        raise upstream_exception(exc)
     if not resumes:
         raise HTTPException(status_code=500, detail='Failed to parse by requested resumes\' params')
 
-    queue_resumes(*resumes)
+    response.headers['X-Complete'] = 'true'
+    response.headers['X-Completeness'] = '1.00'
     return resumes
 
-@app.get('/db/vacancies')
-def default(page: int=0, limit: int=20, filter: str='{}') -> list[Optional[Vacancy]]:
+@app.get('/db/queue')
+def queue_depth() -> dict:
+    return queue_stats()
+
+@app.get('/metrics')
+def metrics_text():
+    measure_queues()
+    live = {('db_spilled_bytes', (('kind', kind),)): spill.stats()['spilled_bytes'] for kind, spill in spills.items()} # Shared, not per process
+    return Response(metrics.collect(live), media_type='text/plain; version=0.0.4')
+
+@app.get('/traces/{id}')
+def trace(id: str, trace: str=None, x_trace_token: str=Header(None)) -> list[dict]:
+    if not tracer.authorized(x_trace_token or trace):
+        raise HTTPException(status_code=403, detail='Traces need the admin token')
+    entries = tracer.find(id) # The request's span tree, then a line per writer batch its rows went into
+    if not entries:
+        raise HTTPException(status_code=404, detail=f'No trace {id}')
+    return entries
+
+@app.get('/search/cache')
+def cache_stats() -> dict:
+    return cache.stats()
+
+@app.get('/search/upstream')
+def upstream_stats() -> dict:
+    return parser.governor.stats()
+
+@app.get('/crawl/status')
+def crawl_status() -> list[dict]:
+    if not crawler:
+        return []
+    return crawler.status()
+
+def rows_response(rows, headers=None):
+    # Rows from the database already have the models' shape, so they skip response validation
+    return Response(content=json.dumps(rows, ensure_ascii=False).encode(), media_type='application/json', headers=headers)
+
+@app.get('/db/vacancies', response_model=list[Optional[Vacancy]])
+def default(page: int=0, limit: int=20, filter: str='{}', cursor: str=None):
     global db
-    return db.get_vacancies_table(page, limit, filter)
+    try:
+        if cursor is None:
+            return rows_response(db.get_vacancies_table(page, limit, filter))
+
+        rows, next_cursor = db.get_vacancies_after(cursor, limit, filter) # Keyset mode, an empty cursor starts from the first row
+    except ValueError as exc: # Malformed filter or cursor
+        raise HTTPException(status_code=400, detail=str(exc))
 
-@app.get('/db/resumes')
-def default(page: int=0, limit: int=20, filter: str='{}') -> list[Optional[Resume]]:
+    return rows_response(rows, headers={'X-Next-Cursor': next_cursor or ''}) # Empty when there are no more rows
+
+@app.get('/db/resumes', response_model=list[Optional[Resume]])
+def default(page: int=0, limit: int=20, filter: str='{}', cursor: str=None):
     global db
-    return db.get_resumes_table(page, limit, filter)
+    try:
+        if cursor is None:
+            return rows_response(db.get_resumes_table(page, limit, filter))
+
+        rows, next_cursor = db.get_resumes_after(cursor, limit, filter) # Keyset mode, an empty cursor starts from the first row
+    except ValueError as exc: # Malformed filter or cursor
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    return rows_response(rows, headers={'X-Next-Cursor': next_cursor or ''}) # Empty when there are no more rows
+
+@app.get('/db/vacancies/search', response_model=list[Optional[Vacancy]])
+def default(q: str, page: int=0, limit: int=20, filter: str='{}'):
+    global db
+    if not q.strip():
+        raise HTTPException(status_code=400, detail='Empty search query')
+
+    try: # Ranked by relevance over name, requirement and responsibility
+        return rows_response(db.search_vacancies(q, page, limit, filter))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@app.get('/db/resumes/search', response_model=list[Optional[Resume]])
+def default(q: str, page: int=0, limit: int=20, filter: str='{}'):
+    global db
+    if not q.strip():
+        raise HTTPException(status_code=400, detail='Empty search query')
+
+    try: # Ranked by relevance over position and about
+        return rows_response(db.search_resumes(q, page, limit, filter))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+def export(table, model, format, filter, columns):
+    columns = columns.split(',') if columns else list(model.model_fields)
+    for column in columns:
+        if column not in model.model_fields:
+            raise HTTPException(status_code=400, detail=f'Unknown column {column}')
+
+    chunks = db.export_rows(table, filter, export_chunk_size)
+    try: # Filter errors surface before the response starts
+        chunks = chain([next(chunks)], chunks)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    if format == 'csv':
+        return StreamingResponse(csv_chunks(chunks, columns), media_type='text/csv',
+                                 headers={'Content-Disposition': f'attachment; filename="{table}.csv"'})
+    return StreamingResponse(ndjson_chunks(chunks, columns), media_type='application/x-ndjson')
+
+@app.get('/export/vacancies')
+def default(format: Literal['ndjson', 'csv']='ndjson', filter: str='{}', columns: str=None):
+    return export('vacancies', Vacancy, format, filter, columns)
+
+@app.get('/export/resumes')
+def default(format: Literal['ndjson', 'csv']='ndjson', filter: str='{}', columns: str=None):
+    return export('resumes', Resume, format, filter, columns)
 
 @app.get('/')
 def default() -> dict:
     return {'detail': 'server functional'}
 
-def to_json(obj):
-    return json.dumps(obj, ensure_ascii=False)
-
 def count_nones(params):
     count = 0
     for param in params:
@@ -0,0 +1,209 @@
+import json
+import os
+from bisect import bisect_left
+from time import monotonic, perf_counter
+
+from src.spill import SpillLog
+
+# Counters, gauges and histograms in the Prometheus text format. Every process records into its own in-memory
+# registry (a dict update per observation) and dumps it to '<directory>/<pid>.json' every few seconds,
+# /metrics merges the dumps of all processes: API workers, writers. Gauges are summed as well. Counters and histograms
+# of exited processes are kept in an archive, their gauges are dropped.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+ARCHIVE = 'archive.json' # Counters and histograms of processes that are gone
+
+DEFINITIONS = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint', LATENCY_BUCKETS),
+    'upstream_request_duration_seconds': ('histogram', 'Upstream request latency by host and page kind, per attempt', LATENCY_BUCKETS),
+    'upstream_requests_total': ('counter', 'Upstream requests by host, page kind and status', None),
+    'upstream_hedges_total': ('counter', 'Hedged upstream requests by host, page kind and which request answered first', None),
+    'parse_duration_seconds': ('histogram', 'HTML parse time per page', LATENCY_BUCKETS),
+    'db_queue_rows': ('gauge', 'Rows waiting in the writer queues', None),
+    'db_spilled_bytes': ('gauge', 'Rows waiting in the spill log', None),
+    'db_upsert_duration_seconds': ('histogram', 'Batch upsert latency', LATENCY_BUCKETS),
+    'db_batch_rows': ('histogram', 'Rows per upserted batch', SIZE_BUCKETS),
+    'db_write_errors_total': ('counter', 'Failed batch upserts by error', None),
+}
+
+class Metrics:
+    def __init__(self):
+        self.values = {} # (name, labels) -> number, or bucket counts + [sum, count] for histograms
+        self.directory = None
+        self.interval = None
+        self.saved_at = 0.0
+
+    def configure(self, directory, interval):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+
+    def reset(self): # A forked process starts from zero, the parent's values are in the parent's dump
+        self.values = {}
+        self.saved_at = 0.0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = DEFINITIONS[name][2]
+
+        histogram = self.values.get(key)
+        if histogram is None:
+            histogram = self.values[key] = [0] * (len(buckets) + 3) # Buckets, +Inf, sum, count
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def save(self, force=False): # Cheap to call often, dumps at most once per interval
+        if not self.directory or not force and monotonic() - self.saved_at < self.interval:
+            return
+        self.saved_at = monotonic()
+
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump([[name, labels, value] for (name, labels), value in self.values.items()], f)
+        os.replace(path + '.tmp', path) # Readers never see a partial dump
+
+    def cleanup(self): # Folds the dumps of processes that are gone into the archive, so summed counters never go down
+        # Run by the leader only, one process at a time rewrites the archive
+        dead = [name for name in os.listdir(self.directory)
+                if name.endswith('.json') and name[:-len('.json')].isdigit() and not SpillLog.alive(int(name[:-len('.json')]))]
+        if not dead:
+            return
+
+        archive_path = os.path.join(self.directory, ARCHIVE)
+        archive = {}
+        if os.path.exists(archive_path):
+            with open(archive_path) as f:
+                archive = {(name, tuple(map(tuple, labels))): value for name, labels, value in json.load(f)}
+
+        for name in dead:
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    values = json.load(f)
+            except ValueError: # Cut short by a crash
+                continue
+            for metric, labels, value in values:
+                if DEFINITIONS.get(metric, ('gauge',))[0] == 'gauge': # A gauge of a dead process measures nothing any more
+                    continue
+                key = (metric, tuple(map(tuple, labels)))
+                archive[key] = add(archive.get(key), value)
+
+        with open(archive_path + '.tmp', 'w') as f:
+            json.dump([[name, labels, value] for (name, labels), value in archive.items()], f)
+        os.replace(archive_path + '.tmp', archive_path)
+        for name in dead: # Only once their values are in the archive
+            os.remove(os.path.join(self.directory, name))
+
+    def collect(self, live={}): # All processes' values merged, this process' own are current
+        merged = {}
+
+        def merge(values):
+            for (name, labels), value in values:
+                key = (name, tuple(map(tuple, labels)))
+                merged[key] = add(merged.get(key), value)
+
+        for name in os.listdir(self.directory) if self.directory else (): # Other processes' dumps and the archive
+            if name.endswith('.json') and name != f'{os.getpid()}.json':
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        merge(((name, labels), value) for name, labels, value in json.load(f))
+                except (OSError, ValueError): # Removed meanwhile
+                    continue
+        merge(self.values.items())
+        merge(live.items())
+
+        return render(merged)
+
+def add(total, value): # Numbers, or histograms' bucket lists element-wise
+    if total is None:
+        return list(value) if isinstance(value, list) else value
+    if isinstance(value, list):
+        return [a + b for a, b in zip(total, value)]
+    return total + value
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, perf_counter() - self.started, **self.labels)
+
+def render(values):
+    lines = []
+    for name, (kind, description, buckets) in DEFINITIONS.items():
+        series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        if not series:
+            continue
+
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+
+    return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def timed(function, *args): # Runs in a pool process, the caller records the time
+    started = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - started
+
+class MetricsMiddleware: # Plain ASGI, times requests until the last body chunk is sent
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        started = perf_counter()
+        status = [500]
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = scope.get('route') # Route templates keep the label set small
+            self.metrics.observe('http_request_duration_seconds', perf_counter() - started,
+                                 endpoint=route.path if route else 'unmatched', method=scope['method'], status=status[0])
+
+metrics = Metrics() # This process' registry
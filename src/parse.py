@@ -1,60 +1,137 @@
+import asyncio
 import httpx
-from  bs4 import BeautifulSoup
-from json import loads
+
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from time import monotonic
+from urllib.parse import quote
+
+from src.extract import parse_resume, parse_resume_links, available_backend
+from src.governor import Governor
+from src.metrics import metrics, timed
+from src.tracing import span
 
 class ParserInstance:
+    schedule_dict = [{"id":"fullDay","name":"Полный день","uid":"full_day"},
+                     {"id":"shift","name":"Сменный график","uid":"shift"},
+                     {"id":"flexible","name":"Гибкий график","uid":"flexible"},
+                     {"id":"remote","name":"Удаленная работа","uid":"remote"},
+                     {"id":"flyInFlyOut","name":"Вахтовый метод","uid":"fly_in_fly_out"}]
+
+    experience_dict = [{"id":"noExperience","name":"Нет опыта"},
+                       {"id":"between1And3","name":"От 1 года до 3 лет"},
+                       {"id":"between3And6","name":"От 3 до 6 лет"},
+                       {"id":"moreThan6","name":"Более 6 лет"}]
+
+    employment_dict = [{"id":"full","name":"Полная занятость"},
+                       {"id":"part","name":"Частичная занятость"},
+                       {"id":"project","name":"Проектная работа"},
+                       {"id":"volunteer","name":"Волонтерство"},
+                       {"id":"probation","name":"Стажировка"}]
+
+    page_size = 20 # Items per page of the search endpoints' 'page' parameter
+    max_page_size = 100 # Largest page either upstream serves
+    api_depth = 2000 # api.hh.ru serves no items past this offset
+
     def __init__(self, config):
         self.get_vacancies_timeout = config['get_vacancies_timeout']
         self.get_resume_timeout = config['get_resume_timeout']
         self.resume_links_timeout = config['resume_links_timeout']
+        self.resume_fetch_concurrency = config['resume_fetch_concurrency']
+        self.resume_hedge_percentile = config['resume_hedge_percentile'] # None disables hedging
+        self.resume_hedge_min_samples = config['resume_hedge_min_samples']
+        self.resume_latencies = deque(maxlen=config['resume_hedge_window']) # Seconds, of the latest resume pages
+        self.resume_fresh_age = config['resume_fresh_age']
+        self.sync_initial_age = config['sync_initial_age']
+        self.html_backend = available_backend(config['html_backend'])
+
+        self.api_url = config['api_url'] # api.hh.ru and hh.ru, or stand-ins such as loadtest/mock_upstream.py
+        self.site_url = config['site_url']
+
+        self.http2 = config['http2']
+        self.limits = httpx.Limits(max_connections=config['max_connections'],
+                                   max_keepalive_connections=config['max_keepalive_connections'],
+                                   keepalive_expiry=config['keepalive_expiry'])
+        self.governor = Governor(config) # Shared limits of every upstream host
+        self.client = None
+        self.executor = None
+
+    async def open(self, executor=None): # Pooled keep-alive client shared by every upstream request
+        self.client = httpx.AsyncClient(http2=self.http2, limits=self.limits, follow_redirects=True)
+        self.executor = executor # HTML parsing runs here, in the default thread pool if None
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+        self.executor = None
+
+    async def get_vacancies(self, page=0, text=None, experience=None, schedule=None, salary=None, employment=None, pages=1, limit=None):
+        filters = ParserInstance.vacancy_filters(text, experience, schedule, salary, employment)
+        per_page, numbers, window = ParserInstance.page_plan(page, pages, limit)
+
+        async def get_page(number):
+            params = f'?page={number}&per_page={per_page}&' + filters
+            return await self.governor.get(self.client, self.api_url + '/vacancies' + params[:-1], kind='vacancies', timeout=self.get_vacancies_timeout)
+
+        responses = await asyncio.gather(*[get_page(number) for number in numbers if number * per_page < ParserInstance.api_depth])
         
-        self.schedule_dict = [{"id":"fullDay","name":"Полный день","uid":"full_day"},
-                              {"id":"shift","name":"Сменный график","uid":"shift"},
-                              {"id":"flexible","name":"Гибкий график","uid":"flexible"},
-                              {"id":"remote","name":"Удаленная работа","uid":"remote"},
-                              {"id":"flyInFlyOut","name":"Вахтовый метод","uid":"fly_in_fly_out"}]
-        
-        self.experience_dict = [{"id":"noExperience","name":"Нет опыта"},
-                                {"id":"between1And3","name":"От 1 года до 3 лет"},
-                                {"id":"between3And6","name":"От 3 до 6 лет"},
-                                {"id":"moreThan6","name":"Более 6 лет"}]
-        
-        self.employment_dict = [{"id":"full","name":"Полная занятость"},
-                                {"id":"part","name":"Частичная занятость"},
-                                {"id":"project","name":"Проектная работа"},
-                                {"id":"volunteer","name":"Волонтерство"},
-                                {"id":"probation","name":"Стажировка"}]
+        result = {} # Pages may overlap when listings shift between requests
 
-    def get_vacancies(self, page=0, text=None, experience=None, schedule=None, salary=None, employment=None):
-        params = f'?page={page}&per_page=20&'
+        for r in responses:
+            for item in r.json()['items']:
+                result.setdefault(item['id'], self.__get_vacancy_params(item))
 
-        if experience:
-            params += f'experience={experience}&'
-        if text:
-            params += f'text={text}&'
-        if employment:
-            for param in employment.split(','):
-                params += f'employment={param}&'
-        if schedule:
-            for param in schedule.split(','):
-                params += f'schedule={param}&'
-        if salary:
-            params += f'salary={salary}&only_with_salary=true&'
+        return list(result.values())[window]
 
-        try:
-            r = httpx.get('https://api.hh.ru/vacancies' + params[:-1], timeout=self.get_vacancies_timeout)
-        except:
-            return None
-        
-        result = []
+    async def get_new_vacancies(self, since=None, text=None, experience=None, schedule=None, salary=None, employment=None):
+        # Everything published since the watermark, newest first. The API serves at most 2000 items per query,
+        # so a longer result is read in windows, each ending where the previous one was cut off.
+        if since is None:
+            since = datetime.now(timezone.utc) - timedelta(seconds=self.sync_initial_age)
 
-        for item in r.json()['items']:
-            result.append(self.__get_vacancy_params(item))
+        filters = ParserInstance.vacancy_filters(text, experience, schedule, salary, employment)
+        result, newest, until = {}, since, None
 
-        return result
+        while True:
+            items, truncated = await self.__get_vacancies_window(filters, since, until) # Raises, so the watermark stays where it was
+
+            for item in items:
+                published_at = ParserInstance.published_at(item)
+                newest = max(newest, published_at)
+                result.setdefault(item['id'], self.__get_vacancy_params(item))
+
+            if not truncated:
+                break
+            oldest = min((ParserInstance.published_at(item) for item in items), default=None)
+            if oldest is None or oldest == until: # The window can't be narrowed any more
+                # What's older than the window wasn't read, the watermark stays there so the next sync retries it
+                print(f'Error syncing vacancies: more than {ParserInstance.api_depth} published at {oldest or since}')
+                newest = oldest or since
+                break
+            until = oldest
+
+        return list(result.values()), newest
+
+    async def __get_vacancies_window(self, filters, since, until):
+        params = f'?per_page=100&order_by=publication_time&date_from={quote(since.isoformat(timespec="seconds"))}&' + filters
+        if until:
+            params += f'date_to={quote(until.isoformat(timespec="seconds"))}&'
+
+        async def get_page(page):
+            r = await self.governor.get(self.client, f'{self.api_url}/vacancies{params}page={page}', kind='vacancies', timeout=self.get_vacancies_timeout)
+            return r.json()
+
+        first = await get_page(0)
+        rest = await asyncio.gather(*[get_page(page) for page in range(1, first['pages'])])
+
+        items = [item for data in [first] + rest for item in data['items']]
+        return items, first['found'] > first['pages'] * first['per_page']
 
-    def get_resumes(self, page=0, text=None, experience=None, schedule=None, salary=None, employment=None):
-        params = f'?page={page}&per_page=20&'
+    async def get_resumes(self, page=0, text=None, experience=None, schedule=None, salary=None, employment=None, pages=1, limit=None, lookup=None, progress=None):
+        progress = progress or ResumeProgress()
+        per_page, numbers, window = ParserInstance.page_plan(page, pages, limit)
+        params = ''
 
         if experience:
             params += f'experience={experience}&'
@@ -68,25 +145,69 @@ class ParserInstance:
                 params += f'schedule={param}&'
         if salary:
             params += f'salary_from={int(salary - 0.1*salary)}&salary_to={int(salary + 0.1*salary)}&label=only_with_salary&'
-        links = self.__get_resume_links(query_text=params[:-1])
-        
+
+        with span('links', pages=len(numbers)):
+            pages = await asyncio.gather(*[self.__get_resume_links(query_text=(f'?page={number}&per_page={per_page}&items_on_page={per_page}&' + params)[:-1]) for number in numbers])
+
+        links = {} # id -> link, first occurrence wins
+        for page_links in pages:
+            for link in page_links or ():
+                links.setdefault(ParserInstance.resume_id(link), link)
+        links = list(links.values())[window]
+
         if not links:
             return None
+        progress.ids = [ParserInstance.resume_id(link) for link in links]
 
-        result = []
+        stored = {}
+        if lookup: # Resumes that are still fresh elsewhere (id -> params) aren't fetched again
+            with span('lookup', ids=len(links)) as traced:
+                stored = progress.stored = await lookup(progress.ids)
+                traced.set(fresh=len(stored))
 
-        for link in links:
+        semaphore = asyncio.Semaphore(self.resume_fetch_concurrency)
+        with span('resumes', count=len(links) - len(stored)):
+            fetched = await asyncio.gather(*[self.__get_resume(semaphore, link, progress) for link in links if ParserInstance.resume_id(link) not in stored], return_exceptions=True)
+
+        errors = [result for result in fetched if isinstance(result, BaseException)]
+        if errors:
+            if len(errors) == len(fetched) and not stored: # Nothing to return, the cause is reported instead
+                raise errors[0]
+            print(f'Error fetching {len(errors)} of {len(fetched)} resumes: ', errors[0])
+
+        return progress.results()
+
+    async def __get_resume(self, semaphore, link, progress):
+        params = None
+        with span('resume', id=ParserInstance.resume_id(link)):
             try:
-                r = httpx.get(link, follow_redirects=True, timeout=self.get_resume_timeout)
-                soup = BeautifulSoup(r.text, 'html.parser')
-            except:
-                continue
-
-            params = self.__get_resume_params(soup)
-            params['id'] = link.split('?')[0].split('/')[-1]
-            result.append(params)
-        
-        return result
+                params = await self.__fetch_resume(semaphore, link)
+                return params
+            finally:
+                progress.fetched[ParserInstance.resume_id(link)] = params # None if it failed
+
+    def hedge_delay(self): # The configured percentile of the latest resume latencies, None until there are enough of them
+        if self.resume_hedge_percentile is None or len(self.resume_latencies) < self.resume_hedge_min_samples:
+            return None
+        latencies = sorted(self.resume_latencies)
+        return latencies[int(self.resume_hedge_percentile * (len(latencies) - 1))]
+
+    async def __fetch_resume(self, semaphore, link):
+        async with semaphore:
+            started = monotonic()
+            # A page that takes longer than most is requested again, one stalled response doesn't hold up the rest.
+            # Hedged pages are recorded at the time the winner took, so the percentile tracks what callers see.
+            r = await self.governor.hedged(self.client, link, self.hedge_delay(), kind='resume', timeout=self.get_resume_timeout)
+            self.resume_latencies.append(monotonic() - started)
+
+        try:
+            params = await self.__parse(parse_resume, r.content, self.html_backend, r.encoding)
+        except Exception as exc: # Markup that isn't a resume page
+            print(f'Error parsing resume {link}: ', exc)
+            return None
+
+        params['id'] = ParserInstance.resume_id(link)
+        return params
 
     def __get_vacancy_params(self, item):
         params = {
@@ -121,101 +242,58 @@ class ParserInstance:
 
         return params
 
-    def __get_resume_params(self, soup):
-        params = {
-            'gender': ParserInstance.text_by_qa(soup, 'resume-personal-gender'),
-            'age': ParserInstance.text_by_qa(soup, 'resume-personal-age'),
-            'birthday': ParserInstance.text_by_qa(soup, 'resume-personal-birthday'),
-            'search_status': ParserInstance.text_by_qa(soup, 'job-search-status'),
-            'address': ParserInstance.text_by_qa(soup, 'resume-personal-address'),
-            'position': ParserInstance.text_by_qa(soup, 'resume-block-title-position'),
-            'about': ParserInstance.text_by_qa(soup, 'resume-block-skills-content'),
-
-            'specializations': None,
-            'salary': None,
-            'currency': None,
-            'preferred_commute_time': None,
-            'skills': None,
-            'employment': None,
-            'moving_status': None,
-            'citizenship': None,
-            'languages': None,
-            'education': None,
-            'work_experience': None,
-            'work_prev_pos': None,
-            'trips_status': None,
-            'schedule': None,
-        }
+    async def __get_resume_links(self, query_text=''):
+        r = await self.governor.get(self.client, self.site_url + '/search/resume' + query_text, kind='links', timeout=self.resume_links_timeout)
+        try:
+            links = await self.__parse(parse_resume_links, r.content, self.html_backend, r.encoding)
+        except Exception as exc:
+            print('Error parsing resume links: ', exc)
+            return None
+
+        if links:
+            links = [self.site_url + link for link in links]
+        return links
+
+    async def __parse(self, function, *args): # Only raw bytes go in and plain dicts/lists come out
+        with span('parse', function=function.__name__) as traced:
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(self.executor, timed, function, *args)
+            traced.set(cpu_ms=round(elapsed * 1000, 2)) # The rest of the span is the wait for a pool process
+        metrics.observe('parse_duration_seconds', elapsed, function=function.__name__)
+        return result
+
+    def page_plan(page, pages, limit):
+        # The window of 'limit' (or 'pages' pages of page_size) items starting at 'page' is read in as few
+        # upstream pages as possible, a single original-sized page is requested as it always was
+        offset, count = page * ParserInstance.page_size, limit or pages * ParserInstance.page_size
+        per_page = ParserInstance.page_size if count <= ParserInstance.page_size else ParserInstance.max_page_size
+
+        first, last = offset // per_page, (offset + count - 1) // per_page
+        skip = offset - first * per_page
+        return per_page, range(first, last + 1), slice(skip, skip + count)
+
+    def vacancy_filters(text=None, experience=None, schedule=None, salary=None, employment=None):
+        params = ''
 
-        data = ParserInstance.text_by_qa(soup, 'resume-block-position-specialization')
-        if data:
-            params['specializations'] = data.replace(', ', ',').split(',')
-
-        data = ParserInstance.text_by_qa(soup, 'resume-block-salary')
-        if data:
-            params['salary'] = ''.join(data.split(' ')[:-2])
-
-        data = soup.find('span', attrs={'class': 'resume-block-travel-time'})
-        if data:
-            params['preferred_commute_time'] = ParserInstance.fix_spaces(data.text)
-
-        data = soup.find(attrs={'data-qa': 'skills-table'})
-        if data:
-            params['skills'] = list(map(lambda x: ParserInstance.fix_spaces(x.text), data.find_all(attrs={'data-qa': 'bloko-tag__text'})))
-
-        data = soup.find(attrs={'data-qa': 'resume-block-specialization-category'})
-        if data:
-            params['employment'], params['schedule'] = list(map(lambda x: ''.join(ParserInstance.fix_spaces(x.text).split(':')[1:]).strip().replace(', ', ',').split(','), data.parent.parent.find_all('p')))
-            
-        data = soup.find(attrs={'data-qa': 'resume-personal-address'})
-        if data:
-            params['moving_status'], params['trips_status'] = [x.strip() for x in ParserInstance.fix_spaces(data.parent.text).split(',')[-2:]]
-
-        data = soup.find(attrs={'data-qa': 'resume-block-additional'})
-        if data:
-            params['citizenship'] = list(map(lambda x: ''.join(ParserInstance.fix_spaces(x.text).split(':')[1:]).strip(), data.find_all('p')))[0]
-
-        data = soup.find_all('p', attrs={'data-qa': 'resume-block-language-item'})
-        if data:
-            params['languages'] = list(map(lambda x: ParserInstance.fix_spaces(x.text), data))        
-            
-        data = soup.find_all(attrs={'data-qa': 'resume-block-education-name'})
-        if data:
-            params['education'] = list(zip(list(map(lambda x: ParserInstance.fix_spaces(x.text), data)), list(map(lambda x: ParserInstance.fix_spaces(x.text), soup.find_all(attrs={'data-qa': 'resume-block-education-organization'})))))
-
-        data = soup.find(attrs={'data-qa': 'resume-block-experience'})
-        if data:
-            params['work_experience'] = ' '.join(data.find('h2').text.split()[2:])
-
-        data = soup.find_all(attrs={'data-qa': 'resume-block-experience-position'})
-        if data:
-            params['work_prev_pos'] = list(map(lambda x: ParserInstance.fix_spaces(x.text), data))
-
-        if params['salary']:
-            currency_cutoff = 0
-            while not params['salary'][:-currency_cutoff].isdigit():
-                currency_cutoff += 1
-
-            params['currency'] = params['salary'][-currency_cutoff:]
-            params['salary'] = int(params['salary'][:-currency_cutoff])
-
-        if params['age']:
-            params['age'] = int(params['age'].split()[0])
+        if experience:
+            params += f'experience={experience}&'
+        if text:
+            params += f'text={text}&'
+        if employment:
+            for param in employment.split(','):
+                params += f'employment={param}&'
+        if schedule:
+            for param in schedule.split(','):
+                params += f'schedule={param}&'
+        if salary:
+            params += f'salary={salary}&only_with_salary=true&'
 
         return params
 
-    def __get_resume_links(self, query_text=''):
-        try:
-            r = httpx.get(f'https://hh.ru/search/resume' + query_text, follow_redirects=True, timeout=self.resume_links_timeout)
-            soup = BeautifulSoup(r.text, 'html.parser')
-        except:
-            return None
+    def published_at(item):
+        return datetime.strptime(item['published_at'], '%Y-%m-%dT%H:%M:%S%z')
 
-        soup = soup.find(attrs={'data-qa': 'resume-serp__results-search'}) # Limits parse area
-            
-        if soup:
-            soup = ['https://hh.ru' + el['href'] for el in soup.find_all('a', attrs={'class': 'bloko-link'})] # Actual links
-        return soup
+    def resume_id(link):
+        return link.split('?')[0].split('/')[-1]
 
     def text_by_qa(soup, name):
         res = soup.find(attrs={'data-qa': name})
@@ -226,3 +304,24 @@ class ParserInstance:
     
     def fix_spaces(text): # reformats \xa0 spaces
         return ' '.join(text.split())
+
+class ResumeProgress: # Filled in by a running get_resumes, callers that stop waiting read what's done so far
+    def __init__(self):
+        self.ids = None # Requested resumes in result order, None until the link pages are in
+        self.stored = {} # id -> params, fresh in the database
+        self.fetched = {} # id -> params, None if fetching or parsing failed
+
+    def results(self):
+        result = []
+        for id in self.ids or ():
+            params = self.stored.get(id) or self.fetched.get(id)
+            if params:
+                result.append(params)
+        return result
+
+    def completeness(self): # Share of the requested resumes that are resolved, fetched or failed
+        if self.ids is None:
+            return 0.0
+        if not self.ids:
+            return 1.0
+        return sum(1 for id in self.ids if id in self.stored or id in self.fetched) / len(self.ids)
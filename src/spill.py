@@ -0,0 +1,90 @@
+import json
+import os
+from time import time, time_ns
+from zlib import crc32
+
+# Append-only on-disk log of row batches that couldn't go through the in-memory queue (or into the database).
+# Every process appends to its own '<time>-<pid>.open' segment, which is renamed to '.seg' once it's full,
+# old enough, or its process stops. Only sealed segments are replayed, so a reader never sees a segment being written.
+# Each line is '<crc32 hex> <json list of rows>', a torn or corrupted line fails its checksum and is skipped.
+
+class SpillLog:
+    def __init__(self, directory, segment_bytes, segment_age):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+
+        self.file = None
+        self.opened_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, rows):
+        if self.file is None:
+            self.file = open(os.path.join(self.directory, f'{time_ns():020d}-{os.getpid()}.open'), 'ab')
+            self.opened_at = time()
+
+        data = json.dumps(rows, ensure_ascii=False, default=str).encode()
+        self.file.write(b'%08x %s\n' % (crc32(data), data))
+        self.file.flush()
+
+        if self.file.tell() >= self.segment_bytes or time() - self.opened_at >= self.segment_age:
+            self.seal()
+
+    def seal(self): # Makes the current segment visible to replay
+        if self.file is None:
+            return
+
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.file.name, self.file.name[:-len('.open')] + '.seg')
+        self.file = None
+
+    def seal_stale(self):
+        if self.file and time() - self.opened_at >= self.segment_age:
+            self.seal()
+
+    def recover(self): # Seals segments left open by processes that are gone
+        for name in os.listdir(self.directory):
+            if name.endswith('.open') and not SpillLog.alive(int(name[:-len('.open')].split('-')[1])):
+                path = os.path.join(self.directory, name)
+                os.rename(path, path[:-len('.open')] + '.seg')
+
+    def segments(self): # Sealed segments, oldest first
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def read(self, path):
+        entries, corrupted = [], 0
+        with open(path, 'rb') as f:
+            for line in f:
+                checksum, _, data = line.rstrip(b'\n').partition(b' ')
+                try:
+                    if int(checksum, 16) != crc32(data):
+                        raise ValueError
+                    entries.append(json.loads(data))
+                except ValueError:
+                    corrupted += 1
+        return entries, corrupted
+
+    def remove(self, path):
+        os.remove(path)
+
+    def stats(self):
+        segments, size = 0, 0
+        for name in os.listdir(self.directory):
+            if name.endswith(('.seg', '.open')):
+                try:
+                    size += os.path.getsize(os.path.join(self.directory, name))
+                except FileNotFoundError: # Replayed meanwhile
+                    continue
+                segments += 1
+
+        return {'spilled_segments': segments, 'spilled_bytes': size}
+
+    def alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
@@ -1,6 +1,9 @@
-import unittest, httpx, json
+import unittest, httpx, json, os, sys
 from structs import Resume, Vacancy
 
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT) # The database tests use the application's modules directly
+
 def get(path):
     r = httpx.get(f'http://localhost:8000{path}', timeout=60.0)
     return r.json()
@@ -68,7 +71,35 @@ class TestVacancies(unittest.TestCase):
     def test_05_db_negative(self):
         r = get('/db/vacancies?page=0&filter={%22id%22:[{%22text%22:%22123%22}],%22type%22:[{%22text%22:%22123%22}],%22currency%22:[{%22text%22:%22123%22}]}')
         self.assertEqual(r, [])
+
+    def test_06_db_cursor(self):
+        pages = get('/db/vacancies?page=0&limit=10') + get('/db/vacancies?page=1&limit=10')
+        r = httpx.get('http://localhost:8000/db/vacancies?limit=10&cursor=')
+        cursor = r.headers['X-Next-Cursor']
+        r = r.json() + get(f'/db/vacancies?limit=10&cursor={cursor}')
+        self.assertEqual([item['id'] for item in r], sorted(item['id'] for item in pages))
+
+    def test_07_db_search(self):
+        r = get('/db/vacancies/search?q=python')
+        self.assertIsInstance(r, list)
+        for item in r:
+            self.assertIn('python', ' '.join(filter(None, [item['name'], item['requirement'], item['responsibility']])).lower())
             
+    def test_08_export(self):
+        r = httpx.get('http://localhost:8000/export/vacancies?columns=id,name')
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        self.assertTrue(all(list(row) == ['id', 'name'] for row in rows))
+
+        r = httpx.get('http://localhost:8000/export/vacancies?format=csv&columns=id')
+        self.assertEqual(r.text.splitlines(), ['id'] + [row['id'] for row in rows])
+        self.assertEqual(httpx.get('http://localhost:8000/export/vacancies?columns=nope').status_code, 400)
+
+    def test_09_search_limit(self):
+        r = get('/search/vacancies?limit=150')
+        self.assertLessEqual(len(r), 150)
+        self.assertEqual(len(r), len({item['id'] for item in r}))
+        self.assertEqual([item['id'] for item in r[:20]], [item['id'] for item in get('/search/vacancies')])
+
 class TestResumes(unittest.TestCase):
     def test_00_search_basic(self):
         r = get('/search/resumes')
@@ -145,5 +176,97 @@ class TestResumes(unittest.TestCase):
         r = get('/db/resumes?page=0&filter={%22age%22:[{%22text%22:%22abc%22}]}')
         self.assertEqual(r, [])
 
+    def test_06_db_skills(self):
+        r = get('/db/resumes?filter={%22skills%22:[{%22op%22:%22all%22,%22value%22:[%22Python%22,%22SQL%22]}]}')
+        for item in r:
+            skills = [skill.lower() for skill in item['skills']]
+            self.assertIn('python', skills)
+            self.assertIn('sql', skills)
+
+    def test_07_search_deadline(self):
+        r = httpx.get('http://localhost:8000/search/resumes?text=python&deadline=0.5', timeout=60.0)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(r.headers['X-Complete'], ('true', 'false'))
+        self.assertLessEqual(float(r.headers['X-Completeness']), 1.0)
+        r = httpx.get('http://localhost:8000/search/resumes?deadline=0')
+        self.assertEqual(r.status_code, 400)
+
+class TestCache(unittest.TestCase):
+    def test_00_search_cached(self):
+        first = get('/search/vacancies?page=1')
+        hits = get('/search/cache')['hits']
+        second = get('/search/vacancies?page=1')
+        self.assertEqual(first, second)
+        self.assertEqual(get('/search/cache')['hits'], hits + 1)
+
+    def test_01_upstream_stats(self):
+        get('/search/vacancies')
+        stats = get('/search/upstream')['api.hh.ru']
+        self.assertGreaterEqual(stats['limit'], 1)
+        self.assertGreaterEqual(stats['requests'], 1)
+
+    def test_02_queue_depth(self):
+        for kind in ('resumes', 'vacancies'):
+            depth = get('/db/queue')[kind]
+            self.assertGreaterEqual(depth['queued_rows'], 0)
+            self.assertGreaterEqual(depth['spilled_segments'], 0)
+
+    def test_03_metrics(self):
+        get('/search/vacancies')
+        r = httpx.get('http://localhost:8000/metrics').text
+        self.assertIn('http_request_duration_seconds_count{endpoint="/search/vacancies"', r)
+        self.assertIn('upstream_request_duration_seconds_bucket{host="api.hh.ru",kind="vacancies"', r)
+
+    def test_04_traces_need_token(self):
+        r = httpx.get('http://localhost:8000/search/vacancies', headers={'X-Trace-Token': 'not the token'}, timeout=60.0)
+        self.assertNotIn('x-trace-id', r.headers)
+        r = httpx.get('http://localhost:8000/traces/0123456789abcdef?trace=not the token')
+        self.assertEqual(r.status_code, 403)
+
+class TestCrawler(unittest.TestCase):
+    def test_00_status(self):
+        for query in get('/crawl/status'):
+            self.assertTrue(query['query'].startswith(('vacancies?', 'resumes?')))
+            self.assertIn('next_run', query)
+
+class TestDatabase(unittest.TestCase):
+    def test_00_set_accent_variants(self): # Written to '<db_name>_test' next to the configured database
+        from sqlalchemy_utils import drop_database
+        from src.db import DatabaseWorker
+
+        with open(os.path.join(ROOT, 'db_config.json')) as f:
+            config = json.load(f)
+        db = DatabaseWorker(dict(config, db_name=config['db_name'] + '_test'))
+        db.setup()
+        try: # Equal under the side tables' accent-insensitive collation, both are kept on the resume itself
+            db.add_resumes([{'id': 'f' * 38, 'skills': ['Отчётность', 'Отчетность', 'Python']}])
+            rows = db.get_resumes_table(0, 20, json.dumps({'skills': [{'op': 'all', 'value': ['Отчетность', 'Python']}]}))
+            self.assertEqual([row['id'] for row in rows], ['f' * 38])
+        finally:
+            db.engine.dispose()
+            drop_database(db.engine.url)
+
+    def test_01_outage_spills(self): # Rows written while MySQL refuses connections wait in the spill log
+        import tempfile
+        from multiprocessing import Queue, Value, Event, Lock
+        from src.db import DatabaseWorker
+        from src.main import push_rows, spill_log, vacancy_row
+
+        with open(os.path.join(ROOT, 'db_config.json')) as f:
+            config = json.load(f)
+        config.update(hostname='127.0.0.1', port=1, spill_dir=tempfile.mkdtemp(), outage_backoff=0.1) # Nothing listens on port 1
+        db = DatabaseWorker(config)
+        spill = spill_log(config, 'vacancies')
+
+        fields = ('name', 'area', 'average_salary', 'currency', 'type', 'employer', 'requirement', 'responsibility', 'schedule', 'experience', 'employment')
+        entry = [dict({field: None for field in fields}, id=str(100000000 + i)) for i in range(20)]
+        queue, queued, stop = Queue(), Value('q', len(entry)), Event()
+        queue.put(entry)
+        queue.put(None)
+        push_rows(stop, Lock(), queue, queued, db.add_vacancies, vacancy_row, config, spill)
+
+        spilled = [params['id'] for segment in spill.segments() for stored in spill.read(segment)[0] for params in stored]
+        self.assertEqual(spilled, [params['id'] for params in entry])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,174 @@
+import json
+import os
+import random
+from contextvars import ContextVar
+from hmac import compare_digest
+from time import perf_counter
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+# Per-request span trees. A request is traced when it carries the admin token ('X-Trace-Token' header or 'trace'
+# query parameter) or is picked by the sample rate, every other request only pays a context variable lookup per span.
+# Finished traces are appended as JSON lines to a log shared by all processes, the writers add a line per traced
+# batch under the same trace id, GET /traces/<id> collects both.
+
+current = ContextVar('span', default=None) # Innermost open span of this task
+
+class Span:
+    def __init__(self, name, trace, attributes):
+        self.name = name
+        self.trace = trace # Id of the request's trace
+        self.attributes = attributes
+        self.children = []
+        self.started = perf_counter()
+        self.duration = None # Open until exited
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.token = current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = perf_counter() - self.started
+        current.reset(self.token)
+        if exc_type:
+            self.attributes['error'] = exc_type.__name__
+
+    def tree(self, origin): # Milliseconds from the root's start
+        return {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 2),
+            'duration_ms': None if self.duration is None else round(self.duration * 1000, 2),
+            **self.attributes,
+            'children': [child.tree(origin) for child in list(self.children)],
+        }
+
+    def totals(self, totals=None): # name -> [milliseconds, count] over the whole tree
+        totals = {} if totals is None else totals
+        for child in list(self.children):
+            if child.duration is not None:
+                total = totals.setdefault(child.name, [0.0, 0])
+                total[0] += child.duration * 1000
+                total[1] += 1
+            child.totals(totals)
+        return totals
+
+class NoSpan: # Stands in when the request isn't traced
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NO_SPAN = NoSpan()
+
+def span(name, **attributes): # Child of the current span, use as 'with span(...) as traced:'
+    parent = current.get()
+    if parent is None:
+        return NO_SPAN
+    child = Span(name, parent.trace, attributes)
+    parent.children.append(child)
+    return child
+
+def trace_id():
+    parent = current.get()
+    return parent.trace if parent else None
+
+class Tracer:
+    def __init__(self):
+        self.token = '' # Empty disables token-triggered traces
+        self.sample_rate = 0.0
+        self.path = None
+        self.max_bytes = None
+
+    def configure(self, token, sample_rate, path, max_bytes):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.token = token
+        self.sample_rate = sample_rate
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def authorized(self, token):
+        return bool(self.token) and token is not None and compare_digest(token.encode(), self.token.encode())
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, entry):
+        if not self.path:
+            return
+        line = (json.dumps(entry, ensure_ascii=False, default=str) + '\n').encode()
+        try: # A single O_APPEND write, lines of concurrent processes don't interleave
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size > self.max_bytes:
+                os.replace(self.path, self.path + '.1') # The previous generation stays readable
+        except OSError as exc: # Tracing never fails the traced work
+            print('Error recording trace: ', exc)
+
+    def find(self, id): # Entries of a trace, oldest first
+        entries = []
+        needle = f'"trace": "{id}"'
+        for path in (self.path + '.1', self.path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    lines = [line for line in f if needle in line]
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError: # Cut by a crash mid-write
+                    continue
+        return entries
+
+class TracingMiddleware: # Plain ASGI like MetricsMiddleware, so spans opened by endpoints see the request's root span
+    def __init__(self, app, tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        forced = self.tracer.authorized(request_token(scope))
+        if not forced and not self.tracer.sampled():
+            return await self.app(scope, receive, send)
+
+        root = Span(scope['path'], uuid4().hex[:16], {'method': scope['method']})
+
+        async def send_traced(message):
+            if message['type'] == 'http.response.start':
+                root.set(status=message['status'])
+                if forced: # Stages finished so far, the full tree is at /traces/<id>
+                    timing = ', '.join(f'{name};desc="{count}x";dur={total:.1f}' for name, (total, count) in root.totals().items())
+                    headers = [(b'x-trace-id', root.trace.encode())] + ([(b'server-timing', timing.encode())] if timing else [])
+                    message = dict(message, headers=list(message.get('headers', [])) + headers)
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, receive, send_traced)
+        finally:
+            route = scope.get('route')
+            if route:
+                root.name = route.path
+            self.tracer.record({'trace': root.trace, 'sampled': not forced, 'pid': os.getpid(), **root.tree(root.started)})
+
+def request_token(scope):
+    for name, value in scope['headers']:
+        if name == b'x-trace-token':
+            return value.decode('latin-1')
+    values = parse_qs(scope['query_string'].decode('latin-1')).get('trace')
+    return values[0] if values else None
+
+tracer = Tracer() # This process' tracer